@@ -16,6 +16,9 @@
 
 
 
+import calendar
+import email.utils
+import httplib
 import json
 import logging
 import mimetypes
@@ -63,6 +66,7 @@ TOP_LEVEL_APPSPOT_COM_REGEX = re.compile(r'^[^\.]+\.appspot\.com$')
 # memcache key space
 MEMCACHE_MANIFEST_PREFIX = 'manifest:'
 MEMCACHE_FILE_KEY_PREFIX = 'file:'
+MEMCACHE_GZIP_FILE_KEY_PREFIX = 'gzipfile:'
 
 # persisted names
 PERSIST_INDEX_NAME = 'index'
@@ -101,6 +105,9 @@ config = lib_config.register('mimic', {
     'CORS_ALLOWED_HEADERS': 'Origin, Accept',
     # shared JSON encoder, for optional pretty printing
     'JSON_ENCODER': json.JSONEncoder(),
+    # number of projects whose target modules stay loaded between requests
+    # while their tree is unchanged, or 0 to load them on every request
+    'WARM_TARGET_ENVIRONMENTS': 0,
     })
 
 # supplement mimetypes.guess_type()'s limited guessing abilities
@@ -137,6 +144,10 @@ class RequestError(Error):
   """An error caused by a failure to communicate with a remote component."""
 
 
+class RangeNotSatisfiableError(Error):
+  """A requested byte range lies entirely beyond the end of a file."""
+
+
 # TODO: Unfortunately this model will pollute the target application's
 # Datastore. The name (prefixed with _Ah) was chosen to minimize collision,
 # but there may be a better mechanism, e.g. by using a namespace.
@@ -176,6 +187,14 @@ class Tree(object):
     """Returns True if the tree can be modifed, False otherwise."""
     return False
 
+  def GetVersion(self):
+    """Returns a stamp which changes whenever the tree is modified.
+
+    Returns:
+      A version stamp, or None if the tree does not track versions.
+    """
+    return None
+
   def GetFileContents(self, path):
     """Returns the contents of a specified file.
 
@@ -188,6 +207,42 @@ class Tree(object):
     """
     raise NotImplementedError
 
+  def GetFileGzipContents(self, path):
+    """Returns the contents of a specified file compressed with gzip.
+
+    Trees which store compressed contents may implement this so that they can
+    be served to clients accepting gzip without recompressing them.
+
+    Args:
+      path: The full path for the file.
+
+    Returns:
+      A string containing the file's contents in the gzip file format, or None
+      if the file does not exist or is not stored compressed.
+    """
+    return None
+
+  def GetFileChunks(self, path, start=0, end=None):
+    """Returns the contents of a specified file as an iterator of chunks.
+
+    Trees should override this when they can read part of a file, or a large
+    file, without loading all of its contents at once.
+
+    Args:
+      path: The full path for the file.
+      start: The offset of the first byte to return.
+      end: The offset just past the last byte to return, or None to return the
+          rest of the file.
+
+    Returns:
+      An iterator of strings which join to the requested contents, or None if
+      the file does not exist.
+    """
+    contents = self.GetFileContents(path)
+    if contents is None:
+      return None
+    return iter([contents[start:end]])
+
   def GetFileSize(self, path):
     """Returns the size of a specified file.
 
@@ -199,6 +254,20 @@ class Tree(object):
     """
     raise NotImplementedError
 
+  def GetFileDigest(self, path):
+    """Returns a digest of a specified file's contents.
+
+    Files with equal contents have equal digests, so the digest can be used to
+    detect changes, e.g. as an HTTP ETag.
+
+    Args:
+      path: The full path for the file.
+
+    Returns:
+      The digest as a hex string, or None if the file does not exist.
+    """
+    raise NotImplementedError
+
   def GetFileLastModified(self, path):
     """Returns the time that a file was last updated.
 
@@ -234,6 +303,18 @@ class Tree(object):
     """
     raise NotImplementedError
 
+  def MovePath(self, path, newpath):
+    """Move or rename a file, or directory and its contents.
+
+    Args:
+      path: The current full path for the file or directory.
+      newpath: The new full path for the file or directory.
+
+    Returns:
+      True if any paths were moved, False otherwise.
+    """
+    raise NotImplementedError
+
   def DeletePath(self, path):
     """Delete a file, or directory and its contents.
 
@@ -291,7 +372,7 @@ class Tree(object):
     """
     raise NotImplementedError
 
-  def Files(self, path):
+  def GetFiles(self, path):
     """Retrieve files in the tree with leading path.
 
     Args:
@@ -410,3 +491,199 @@ def GuessMimeType(filename):
   if mime_type.startswith('text/') and '; charset=' not in mime_type:
     mime_type += '; charset=utf-8'
   return mime_type
+
+
+def AcceptsGzip(accept_encoding):
+  """Check whether an Accept-Encoding header value allows gzip.
+
+  Args:
+    accept_encoding: The value of the Accept-Encoding header, or None.
+
+  Returns:
+    True if gzip content coding is acceptable, False otherwise.
+  """
+  for coding in (accept_encoding or '').split(','):
+    params = coding.split(';')
+    if params[0].strip().lower() not in ('gzip', 'x-gzip'):
+      continue
+    for param in params[1:]:
+      name, _, value = param.partition('=')
+      if name.strip() == 'q':
+        try:
+          return float(value) > 0
+        except ValueError:
+          return False
+    return True
+  return False
+
+
+def MakeETags(digest):
+  """Returns the ETags for the identity and gzip encodings of a file.
+
+  Args:
+    digest: The file's digest, see Tree.GetFileDigest().
+
+  Returns:
+    An (identity_etag, gzip_etag) tuple of quoted, strong ETags.
+  """
+  return '"{0}"'.format(digest), '"{0}-gzip"'.format(digest)
+
+
+def FindETag(header, etags):
+  """Find which of a file's ETags are listed in a request header.
+
+  Args:
+    header: An If-None-Match or If-Range header value, or None.
+    etags: The file's ETags, see MakeETags().
+
+  Returns:
+    The first of etags listed in header, or None. A '*' header matches the
+    first ETag.
+  """
+  if not header:
+    return None
+  if header.strip() == '*':
+    return etags[0]
+  listed = [tag.strip() for tag in header.split(',')]
+  listed = [tag[2:] if tag.startswith('W/') else tag for tag in listed]
+  for etag in etags:
+    if etag in listed:
+      return etag
+  return None
+
+
+def IsModifiedSince(header, last_modified):
+  """Check a file's last modified time against an HTTP date.
+
+  Args:
+    header: An If-Modified-Since or If-Range header value, or None.
+    last_modified: The datetime, in UTC, that the file was last updated.
+
+  Returns:
+    False if header is a valid date no earlier than last_modified, otherwise
+    True.
+  """
+  parsed = email.utils.parsedate_tz(header) if header else None
+  if parsed is None or last_modified is None:
+    return True
+  # HTTP dates have a resolution of one second
+  return (calendar.timegm(last_modified.utctimetuple()) >
+          email.utils.mktime_tz(parsed))
+
+
+def ParseRange(header, size):
+  """Parse a Range header value requesting a single range of bytes.
+
+  Args:
+    header: The Range header value, or None.
+    size: The size of the file in bytes.
+
+  Returns:
+    A (start, end) tuple of the offset of the first byte and the offset just
+    past the last byte, or None if the whole file should be sent, because
+    the header is missing, invalid or requests several ranges.
+
+  Raises:
+    RangeNotSatisfiableError: If the range starts beyond the end of the file,
+        or the file is empty.
+  """
+  if not header:
+    return None
+  unit, _, spec = header.partition('=')
+  if unit.strip().lower() != 'bytes' or ',' in spec:
+    return None
+  first, sep, last = spec.strip().partition('-')
+  if not sep:
+    return None
+  try:
+    if first:
+      start = int(first)
+      end = int(last) + 1 if last else size
+      if end <= start:
+        return None
+    else:
+      start = size - int(last)
+      end = size
+      if start >= end:
+        return None
+  except ValueError:
+    return None
+  if start >= size or size == 0:
+    raise RangeNotSatisfiableError()
+  return max(start, 0), min(end, size)
+
+
+def GetFileResponse(tree, path, get_header):
+  """Determine the response to a GET request for a file.
+
+  Conditional requests are answered from the tree's metadata, so that a 304
+  response never loads the file's contents. Otherwise a single byte range, or
+  gzip encoded contents, are sent when requested and available.
+
+  Args:
+    tree: A tree object to use to retrieve the file.
+    path: The full path for the file.
+    get_header: A function returning the value of a request header given its
+        name, or None if the header is missing.
+
+  Returns:
+    A (status_code, headers, data) tuple, or None if the file does not exist.
+    headers is a list of (name, value) tuples, and data is an iterable of
+    strings, which may read the file as it is consumed, or None for responses
+    without a body.
+  """
+  digest = tree.GetFileDigest(path)
+  if digest is None:
+    return None
+  last_modified = tree.GetFileLastModified(path)
+  identity_etag, gzip_etag = MakeETags(digest)
+  headers = [('Last-Modified', last_modified.strftime(RFC_1123_DATE_FORMAT)),
+             ('Accept-Ranges', 'bytes')]
+
+  if_none_match = get_header('If-None-Match')
+  etag = FindETag(if_none_match, (identity_etag, gzip_etag))
+  if etag or (if_none_match is None and not IsModifiedSince(
+      get_header('If-Modified-Since'), last_modified)):
+    headers.append(('ETag', etag or identity_etag))
+    return httplib.NOT_MODIFIED, headers, None
+
+  range_header = get_header('Range')
+  if_range = get_header('If-Range')
+  if range_header and if_range:
+    if if_range.startswith('"') or if_range.startswith('W/'):
+      # ranges require a strong match
+      satisfies_if_range = if_range.strip() == identity_etag
+    else:
+      satisfies_if_range = not IsModifiedSince(if_range, last_modified)
+    if not satisfies_if_range:
+      range_header = None
+  if range_header:
+    size = tree.GetFileSize(path)
+    try:
+      byte_range = ParseRange(range_header, size)
+    except RangeNotSatisfiableError:
+      headers.extend([('ETag', identity_etag),
+                      ('Content-Range', 'bytes */{0}'.format(size))])
+      return httplib.REQUESTED_RANGE_NOT_SATISFIABLE, headers, None
+    if byte_range is not None:
+      start, end = byte_range
+      chunks = tree.GetFileChunks(path, start, end)
+      if chunks is None:
+        return None
+      headers.extend([('ETag', identity_etag),
+                      ('Content-Range',
+                       'bytes {0}-{1}/{2}'.format(start, end - 1, size))])
+      return httplib.PARTIAL_CONTENT, headers, chunks
+
+  if AcceptsGzip(get_header('Accept-Encoding')):
+    data = tree.GetFileGzipContents(path)
+    if data is not None:
+      # an uncompressed response suits any client, so only vary this one
+      headers.extend([('ETag', gzip_etag), ('Content-Encoding', 'gzip'),
+                      ('Vary', 'Accept-Encoding')])
+      return httplib.OK, headers, [data]
+  chunks = tree.GetFileChunks(path)
+  if chunks is None:
+    return None
+  headers.append(('ETag', identity_etag))
+  return httplib.OK, headers, chunks
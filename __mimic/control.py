@@ -119,7 +119,8 @@ class _DirHandler(_TreeHandler):
 
 def prepare_zip_response_from_tree(
     response, tree, filename, use_basepath=False):
-  paths = tree.ListDirectory(None)
+  # fetching all of the files at once lets the tree fetch them concurrently
+  files = sorted(tree.GetFiles(None))
   buf = cStringIO.StringIO()
   zf = zipfile.ZipFile(buf, mode='w', compression=zipfile.ZIP_DEFLATED)
 
@@ -129,15 +130,14 @@ def prepare_zip_response_from_tree(
     if basepath.startswith('repos/'):
       basepath = basepath[len('repos/'):]
 
-  for path in paths:
+  for path, contents, last_modified in files:
     if path.endswith('.playground'):
       continue
 
-    last_modified = tree.GetFileLastModified(path)
     zi = zipfile.ZipInfo(basepath + path,
                          last_modified.timetuple()[:6])
     zi.external_attr = 0640 << 16L # -rw-r-----
-    zf.writestr(zi, tree.GetFileContents(path))
+    zf.writestr(zi, contents)
   zf.close()
   content_disposition = 'attachment; filename="{}"'.format(filename)
 
@@ -194,8 +194,9 @@ class _FileHandler(_TreeHandler):
       self.error(httplib.BAD_REQUEST)
       self.response.write('Path must be specified')
       return
-    data = self._tree.GetFileContents(path)
-    if data is None:
+    response = common.GetFileResponse(self._tree, path,
+                                      self.request.headers.get)
+    if response is None:
       self.error(httplib.NOT_FOUND)
 
       # Technically the error message is not served as HTML so we
@@ -205,12 +206,14 @@ class _FileHandler(_TreeHandler):
 
       self.response.write('File does not exist: %s' % safe_path)
       return
-    last_modified = self._tree.GetFileLastModified(path)
-    last_modified_str = last_modified.strftime(common.RFC_1123_DATE_FORMAT)
+    status_code, headers, data = response
+    self.response.set_status(status_code)
     self.response.headers['Content-Type'] = common.GuessMimeType(path)
     self.response.headers['X-Content-Type-Options'] = 'nosniff'
-    self.response.headers['Last-Modified'] = last_modified_str
-    self.response.out.write(data)
+    for name, value in headers:
+      self.response.headers[name] = value
+    for chunk in data or []:
+      self.response.out.write(chunk)
 
   def put(self):  # pylint: disable-msg=C6409
     """Set a file's contents."""
@@ -225,10 +228,10 @@ class _FileHandler(_TreeHandler):
 
 
 class _MoveHandler(_TreeHandler):
-  """Handler for moving files."""
+  """Handler for moving files and directories."""
 
   def post(self):  # pylint: disable-msg=C6409
-    """Rename file with the specified path."""
+    """Rename file or directory with the specified path."""
     path = self.request.get('path')
     newpath = self.request.get('newpath')
     if not path or not self._tree.IsMutable():
@@ -237,7 +240,7 @@ class _MoveHandler(_TreeHandler):
     if not newpath or newpath == path:
       self.error(httplib.BAD_REQUEST)
       return
-    self._tree.MoveFile(path, newpath)
+    self._tree.MovePath(path, newpath)
 
 
 class _IndexHandler(webapp.RequestHandler):
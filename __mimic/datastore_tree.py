@@ -16,49 +16,459 @@
 
 
 
+import hashlib
+import itertools
+import logging
+import pickle
+import struct
+import time
+import zlib
 
 from . import common
 
+from google.appengine.api import datastore
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
+from google.appengine.ext.ndb import metadata
 
 # The total entity size is 1048572 (1MB - 4), and having some margin below it.
 MAX_BYTES_FOR_ENTITY = 921600  # 900 kbytes
 
+# Values larger than this are split across several memcache keys, leaving some
+# margin below memcache.MAX_VALUE_SIZE for the key and flags.
+MAX_BYTES_FOR_MEMCACHE_VALUE = 921600  # 900 kbytes
+
+# Contents smaller than this aren't worth compressing.
+MIN_BYTES_FOR_COMPRESSION = 1024
+
+# Contents are stored compressed when that saves at least 10%.
+MAX_COMPRESSION_RATIO = 0.9
+
+# PutFiles writes files in transactions of at most this many files, which
+# keeps each transaction well below the datastore's limits.
+MAX_FILES_PER_TRANSACTION = 100
+
+# The _AhMimicFile encoding of contents compressed by _Deflate.
+ENCODING_DEFLATE = 'deflate'
+
+# A gzip member header, without a file name or modification time.
+_GZIP_HEADER = '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
 
 def _SplitByLength(seq, length):
   """A helper function for spliting a string or blob into sized chunks."""
   return [seq[i:i+length] for i in range(0, len(seq), length)]
 
 
+@common.RequiresOriginalMemcache
+def _CacheGet(key):
+  """Get a str value stored by _CacheSet, or None (always for a None key)."""
+  if key is None:
+    return None
+  namespace = common.config.NAMESPACE
+  value = memcache.get(key, namespace=namespace)
+  if not isinstance(value, (int, long)):
+    return value
+  # value is the number of pieces of a large value
+  piece_keys = ['{0}:{1}'.format(key, i) for i in range(value)]
+  pieces = memcache.get_multi(piece_keys, namespace=namespace)
+  if len(pieces) != len(piece_keys):
+    return None
+  return ''.join(pieces[k] for k in piece_keys)
+
+
+@common.RequiresOriginalMemcache
+def _CacheSet(key, value):
+  """Set a str value, splitting it across several keys when necessary.
+
+  Values are kept in mimic's own namespace, so they never collide with the
+  target application's use of memcache.  Nothing is stored for a None key.
+  """
+  if key is None:
+    return
+  namespace = common.config.NAMESPACE
+  if len(value) <= MAX_BYTES_FOR_MEMCACHE_VALUE:
+    memcache.set(key, value, namespace=namespace)
+    return
+  pieces = _SplitByLength(value, MAX_BYTES_FOR_MEMCACHE_VALUE)
+  mapping = dict(('{0}:{1}'.format(key, i), piece)
+                 for i, piece in enumerate(pieces))
+  if not memcache.set_multi(mapping, namespace=namespace):
+    # only store the number of pieces once all of them are present
+    memcache.set(key, len(pieces), namespace=namespace)
+
+
+def _Deflate(contents):
+  """Compress contents into a raw deflate stream, split into segments.
+
+  The stream is fully flushed after every MAX_BYTES_FOR_ENTITY bytes of the
+  contents. Each segment therefore inflates on its own to the corresponding
+  chunk of the contents, while the joined segments remain a single stream.
+
+  Returns:
+    A list of segments, one for each MAX_BYTES_FOR_ENTITY bytes of contents.
+  """
+  compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                -zlib.MAX_WBITS)
+  chunks = _SplitByLength(contents, MAX_BYTES_FOR_ENTITY)
+  segments = []
+  for i, chunk in enumerate(chunks):
+    if i == len(chunks) - 1:
+      segments.append(compressor.compress(chunk) + compressor.flush())
+    else:
+      segments.append(compressor.compress(chunk) +
+                      compressor.flush(zlib.Z_FULL_FLUSH))
+  return segments
+
+
+def _Inflate(segment):
+  """Decompress a single segment produced by _Deflate."""
+  return zlib.decompressobj(-zlib.MAX_WBITS).decompress(segment)
+
+
+def _Encode(contents):
+  """Choose how to store contents.
+
+  Returns:
+    A (chunks, encoding) tuple, with the chunks to store and the encoding of
+    the contents, ENCODING_DEFLATE or None.
+  """
+  if len(contents) >= MIN_BYTES_FOR_COMPRESSION:
+    segments = _Deflate(contents)
+    if sum(map(len, segments)) <= len(contents) * MAX_COMPRESSION_RATIO:
+      return segments, ENCODING_DEFLATE
+  return _SplitByLength(contents, MAX_BYTES_FOR_ENTITY), None
+
+
+def _Digest(contents):
+  """Returns the digest identifying a file's contents."""
+  return hashlib.sha1(contents).hexdigest()
+
+
+def _Utf8(path):
+  """Return path as a utf-8 encoded str."""
+  if isinstance(path, unicode):
+    return path.encode('utf-8')
+  return path
+
+
+def _IndexEntries(path):
+  """Determine the directory index entries for a file path.
+
+  A directory is identified by its normalized path prefix, i.e. the directory
+  path with a trailing '/', or '' for the root of the tree.
+
+  Examples:
+    'a/b/c.py' -> [('', 'a', False), ('a/', 'b', False), ('a/b/', 'c.py', True)]
+    'foo'      -> [('', 'foo', True)]
+
+  Args:
+    path: The full path for a file.
+
+  Returns:
+    A list of (prefix, name, is_file) tuples, one for each directory containing
+    the file, ordered from the root of the tree to the file's own directory.
+  """
+  path = _Utf8(path)
+  entries = []
+  start = 0
+  while True:
+    end = path.find('/', start)
+    if end == -1:
+      entries.append((path[:start], path[start:], True))
+      return entries
+    entries.append((path[:start], path[start:end], False))
+    start = end + 1
+
+
+def _ParentPrefix(prefix):
+  """Split a non empty directory prefix into its parent prefix and name."""
+  head, sep, name = prefix[:-1].rpartition('/')
+  return head + sep, name
+
+
 # TODO: Unfortunately this model will pollute the target application's
 # Datastore.  The name (prefixed with _Ah) was chosen to minimize collision,
 # but there may be a better mechanism.
 class _AhMimicFile(ndb.Model):
   """A Model to store file contents in Datastore.
 
-  The file's path should be used as the key for the entity.
+  The file's path should be used as the key for the entity. The size and digest
+  of the contents are stored alongside so that they are known without loading
+  the contents (files stored before they were recorded lack both, see
+  BackfillMetadata).
+
+  Compressible contents are stored with an encoding of ENCODING_DEFLATE, along
+  with the crc32 of the contents, so they can also be served as gzip.
   """
   contents = ndb.BlobProperty()
   chunk_keys = ndb.KeyProperty(repeated=True, indexed=False)
   updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+  size = ndb.IntegerProperty(indexed=False)
+  digest = ndb.StringProperty(indexed=False)
+  encoding = ndb.StringProperty(indexed=False)
+  crc32 = ndb.IntegerProperty(indexed=False)
+
+  # contents are cached by DatastoreTree itself, see GetFileContents
+  _use_memcache = False
 
   def GetContents(self):
+    return self.GetContentsAsync().get_result()
+
+  @ndb.tasklet
+  def GetContentsAsync(self):
+    contents_list = yield self.GetStoredChunksAsync()
+    if self.encoding == ENCODING_DEFLATE:
+      contents_list = [_Inflate(segment) for segment in contents_list]
+    raise ndb.Return(''.join(contents_list))
+
+  @ndb.tasklet
+  def GetStoredChunksAsync(self):
+    """Returns the chunks of the contents as stored, i.e. still encoded."""
     if self.chunk_keys:
-      chunk_list = ndb.get_multi(self.chunk_keys)
-      contents_list = [chunk.contents for chunk in chunk_list]
-      return ''.join(contents_list)
+      chunk_list = yield ndb.get_multi_async(self.chunk_keys)
+      raise ndb.Return([chunk.contents for chunk in chunk_list])
     else:
-      return self.contents
+      raise ndb.Return([self.contents or ''])
+
+  def IterContents(self, start, end):
+    """Yields the contents between two offsets, one chunk at a time.
+
+    Only the chunks overlapping the range are fetched, and each chunk is
+    fetched while the previous one is being consumed.
+
+    Args:
+      start: The offset of the first byte to return.
+      end: The offset just past the last byte to return.
+    """
+    if not self.chunk_keys:
+      yield self.GetContents()[start:end]
+      return
+    first = start // MAX_BYTES_FOR_ENTITY
+    keys = self.chunk_keys[first:(end - 1) // MAX_BYTES_FOR_ENTITY + 1]
+    offset = first * MAX_BYTES_FOR_ENTITY
+    future = keys[0].get_async()
+    for i in range(len(keys)):
+      contents = future.get_result().contents
+      if i + 1 < len(keys):
+        future = keys[i + 1].get_async()
+      if self.encoding == ENCODING_DEFLATE:
+        contents = _Inflate(contents)
+      yield contents[max(start - offset, 0):end - offset]
+      offset += MAX_BYTES_FOR_ENTITY
+
+  def GetGzipContents(self):
+    """Returns the ENCODING_DEFLATE contents in the gzip file format."""
+    assert self.encoding == ENCODING_DEFLATE
+    return ''.join([_GZIP_HEADER] + self.GetStoredChunksAsync().get_result() +
+                   [struct.pack('<II', self.crc32, self.size & 0xffffffff)])
 
 
 class _AhMimicChunk(ndb.Model):
   """A Model to store a chunk of file contents.
 
   All of the siblings should have one single _AhMimicFile entity as a parent.
+  Files are no longer stored this way, see _AhMimicBlob, but existing chunks
+  are still read.
   """
   contents = ndb.BlobProperty()
 
 
+class _AhMimicBlob(ndb.Model):
+  """A Model to store a chunk of file contents, shared by all trees.
+
+  The chunk is stored as encoded by its files, see _AhMimicFile. The digest of
+  the chunk should be used as the key for the entity, so that identical chunks
+  are only stored once no matter how many files, in however many trees,
+  contain them. Blobs are kept in mimic's own namespace and are deleted once no
+  file references them, see _AhMimicBlobRefCount.
+  """
+  contents = ndb.BlobProperty()
+
+  # contents are cached by DatastoreTree itself, see GetFileContents
+  _use_memcache = False
+
+
+class _AhMimicBlobRefCount(ndb.Model):
+  """A Model to count the file references to an _AhMimicBlob.
+
+  The blob should be used as the parent of the entity. The count is kept apart
+  from the blob so that storing contents which are already known only writes
+  this small entity.
+  """
+  count = ndb.IntegerProperty(indexed=False)
+
+
+@ndb.tasklet
+def _AdjustBlobRefCountAsync(key, delta, contents):
+  """Add delta references to a blob, creating or deleting it as necessary."""
+  count_key = ndb.Key(_AhMimicBlobRefCount, 1, parent=key)
+
+  @ndb.tasklet
+  def Txn():
+    refs = yield count_key.get_async()
+    count = (refs.count if refs else 0) + delta
+    if count > 0:
+      entities = [_AhMimicBlobRefCount(key=count_key, count=count)]
+      if refs is None:
+        entities.append(_AhMimicBlob(key=key, contents=contents))
+      yield ndb.put_multi_async(entities)
+    else:
+      yield ndb.delete_multi_async([count_key, key])
+
+  yield ndb.transaction_async(Txn)
+
+
+@ndb.tasklet
+def _AdjustBlobRefCountsAsync(deltas):
+  """Apply a dict mapping blob keys to (delta, contents) tuples."""
+  yield [_AdjustBlobRefCountAsync(key, delta, contents)
+         for key, (delta, contents) in deltas.iteritems() if delta]
+
+
+@ndb.tasklet
+def _AddBlobRefsAsync(chunks_list):
+  """Store chunks in the blob store, adding a reference to each of them.
+
+  References must be added before a file entity refers to the blobs, and only
+  released after it no longer does, so that a failure in between leaks a blob
+  rather than losing one which is still in use.
+
+  Args:
+    chunks_list: A list with the stored chunks of each file.
+
+  Returns:
+    A list with the blob keys for each file.
+  """
+  keys_list = []
+  deltas = {}
+  for chunks in chunks_list:
+    keys = []
+    for chunk in chunks:
+      key = ndb.Key(_AhMimicBlob, _Digest(chunk),
+                    namespace=common.config.NAMESPACE)
+      deltas[key] = (deltas.get(key, (0, None))[0] + 1, chunk)
+      keys.append(key)
+    keys_list.append(keys)
+  yield _AdjustBlobRefCountsAsync(deltas)
+  raise ndb.Return(keys_list)
+
+
+def _ReleaseBlobRefsAsync(keys):
+  """Release a reference to each of the blob keys, see _AddBlobRefsAsync."""
+  deltas = {}
+  for key in keys:
+    deltas[key] = (deltas.get(key, (0, None))[0] - 1, None)
+  return _AdjustBlobRefCountsAsync(deltas)
+
+
+def _ReleaseBlobRefs(keys):
+  _ReleaseBlobRefsAsync(keys).get_result()
+
+
+def _ChunkKeys(entities):
+  """Split the chunk keys of _AhMimicFile entities by how they are disposed of.
+
+  Args:
+    entities: _AhMimicFile entities which are going away; None is ignored.
+
+  Returns:
+    A (chunk_keys, blob_keys) tuple. The _AhMimicChunk keys must be deleted
+    along with their files, while the references to the _AhMimicBlob keys must
+    be released once their files are gone.
+  """
+  chunk_keys = []
+  blob_keys = []
+  for entity in entities:
+    if entity is None:
+      continue
+    for key in entity.chunk_keys:
+      if key.kind() == _AhMimicBlob._get_kind():  # pylint: disable-msg=W0212
+        blob_keys.append(key)
+      else:
+        chunk_keys.append(key)
+  return chunk_keys, blob_keys
+
+
+class _AhMimicDirectory(ndb.Model):
+  """A Model whose keys identify the directories of a tree.
+
+  The directory's normalized path prefix, with a leading '/' so that the root
+  directory has a non empty id, should be used as the key. All of the
+  directories should have the tree's root key as a parent. No entities are
+  stored, a directory exists as long as it has entries, see
+  _AhMimicDirectoryEntry.
+  """
+
+
+class _AhMimicDirectoryEntry(ndb.Model):
+  """A Model to index a single entry of a directory.
+
+  The entry's name, with a trailing '/' for a subdirectory, should be used as
+  the key for the entity, and the _AhMimicDirectory key as its parent.  Each
+  entry is a separate entity, so directories can grow without bound, and the
+  entries of a directory are found with an ancestor query.
+
+  File entries describe their file, so that metadata is known without loading
+  any file entities. The properties of subdirectory entries are None.
+  """
+  size = ndb.IntegerProperty(indexed=False)
+  digest = ndb.StringProperty(indexed=False)
+  chunk_count = ndb.IntegerProperty(indexed=False)
+  updated = ndb.DateTimeProperty(indexed=False)
+
+  # the index is read with queries, which never use memcache
+  _use_memcache = False
+
+
+def _EntryName(key):
+  """Returns the name of an _AhMimicDirectoryEntry from its key."""
+  name = key.id()
+  if name.endswith('/'):
+    return name[:-1]
+  return name
+
+
+def _IsFileEntry(key):
+  """Returns True if an _AhMimicDirectoryEntry key describes a file."""
+  return not key.id().endswith('/')
+
+
+def _MakeFileInfo(entity):
+  """Describe a _AhMimicFile entity which has been put.
+
+  Returns:
+    An _AhMimicDirectoryEntry without a key.
+  """
+  size = entity.size
+  digest = entity.digest
+  if size is None or digest is None:
+    contents = entity.GetContents()
+    size = len(contents)
+    digest = _Digest(contents)
+  return _AhMimicDirectoryEntry(size=size, digest=digest,
+                                chunk_count=len(entity.chunk_keys),
+                                updated=entity.updated)
+
+
+def BackfillMetadata():
+  """Backfill the size and digest of files in every namespace.
+
+  This is a one off migration for files stored before _AhMimicFile recorded
+  their size and digest, suitable for running via the deferred library or
+  remote_api.
+
+  Returns:
+    The number of file entities which were updated.
+  """
+  count = 0
+  for namespace in metadata.get_namespaces():
+    if namespace:
+      count += DatastoreTree(namespace).BackfillMetadata()
+  return count
+
+
 class DatastoreTree(common.Tree):
   """An implementation of Tree backed by Datastore."""
 
@@ -70,6 +480,11 @@ class DatastoreTree(common.Tree):
     assert namespace is not None
     self.root = ndb.Key(_AhMimicFile, '/',
                         namespace=namespace or common.config.NAMESPACE)
+    self._index_checked = False
+    self._version = None
+    self._manifest = None
+    # False once the version could not be changed, see _BumpVersion()
+    self._caching = True
 
   def __repr__(self):
     return '<{0} root={1}>'.format(self.__class__.__name__, self.root)
@@ -77,121 +492,436 @@ class DatastoreTree(common.Tree):
   def IsMutable(self):
     return True
 
+  @common.RequiresOriginalMemcache
+  def GetVersion(self):
+    """Returns a stamp which changes whenever the tree is modified.
+
+    The version is kept in memcache. Should it be evicted a new, time based,
+    version is started so that stale values cached under an older version are
+    never seen again.
+
+    Returns:
+      The version, or None if caching has been disabled for this tree.
+    """
+    if not self._caching:
+      return None
+    if self._version is None:
+      key = self._VersionCacheKey()
+      namespace = common.config.NAMESPACE
+      self._version = memcache.get(key, namespace=namespace)
+      if self._version is None:
+        version = int(time.time() * 1000)
+        if memcache.add(key, version, namespace=namespace):
+          self._version = version
+        else:
+          self._version = memcache.get(key, namespace=namespace) or version
+    return self._version
+
+  @common.RequiresOriginalMemcache
+  def _BumpVersion(self):
+    """Invalidate everything cached for this tree, see GetVersion()."""
+    self._manifest = None
+    key = self._VersionCacheKey()
+    namespace = common.config.NAMESPACE
+    self._version = memcache.incr(key, namespace=namespace,
+                                  initial_value=int(time.time() * 1000))
+    if self._version is not None:
+      return
+    # The old version, and everything cached under it, may still be in
+    # memcache.  Removing it makes GetVersion() start a new version.
+    if (memcache.delete(key, namespace=namespace) ==
+        memcache.DELETE_NETWORK_FAILURE):
+      logging.error('Unable to invalidate the cached files of %r', self)
+      self._caching = False
+
+  def _VersionCacheKey(self):
+    return '{0}version:{1}'.format(common.MEMCACHE_FILE_KEY_PREFIX,
+                                   self.root.namespace())
+
+  def _FileCacheKey(self, path, prefix=common.MEMCACHE_FILE_KEY_PREFIX):
+    """Returns the memcache key of a file, or None if caching is disabled."""
+    version = self.GetVersion()
+    if version is None:
+      return None
+    return '{0}{1}:{2}:{3}'.format(prefix, self.root.namespace(), version,
+                                   path)
+
   def GetFileContents(self, path):
+    key = self._FileCacheKey(path)
+    contents = _CacheGet(key)
+    if contents is not None:
+      return contents
     entity = _AhMimicFile.get_by_id(path, parent=self.root)
     if entity is None:
       return None
-    return entity.GetContents()
+    contents = entity.GetContents()
+    _CacheSet(key, contents)
+    return contents
 
-  def GetFileSize(self, path):
-    contents = self.GetFileContents(path)
+  def GetFileChunks(self, path, start=0, end=None):
+    size = self.GetFileSize(path)
+    if size is None:
+      return None
+    end = size if end is None else min(end, size)
+    if start >= end:
+      return iter([])
+    if size <= MAX_BYTES_FOR_MEMCACHE_VALUE:
+      # small enough to be cached whole
+      return iter([self.GetFileContents(path)[start:end]])
+    entity = _AhMimicFile.get_by_id(path, parent=self.root)
+    if entity is None:
+      return None
+    return entity.IterContents(start, end)
+
+  def GetFileGzipContents(self, path):
+    key = self._FileCacheKey(path, common.MEMCACHE_GZIP_FILE_KEY_PREFIX)
+    contents = _CacheGet(key)
     if contents is None:
+      entity = _AhMimicFile.get_by_id(path, parent=self.root)
+      # '' is cached for files which aren't stored compressed
+      contents = ''
+      if entity is not None and entity.encoding == ENCODING_DEFLATE:
+        contents = entity.GetGzipContents()
+      _CacheSet(key, contents)
+    return contents or None
+
+  def _GetManifest(self):
+    """Returns a dict describing every file in the tree.
+
+    The manifest is built from the directory index and cached in memcache for
+    the current version of the tree, so that metadata queries don't need to
+    fetch any file entities.
+
+    Returns:
+      A dict mapping each file's full path to a (size, last_updated, digest,
+      chunk_count) tuple.
+    """
+    if self._manifest is not None:
+      return self._manifest
+    key = self._FileCacheKey('', common.MEMCACHE_MANIFEST_PREFIX)
+    pickled = _CacheGet(key)
+    if pickled is not None:
+      self._manifest = pickle.loads(pickled)
+      return self._manifest
+    self._RebuildIndexIfMissing()
+    manifest = {}
+    for entry in _AhMimicDirectoryEntry.query(ancestor=self.root):
+      if _IsFileEntry(entry.key):
+        path = entry.key.parent().id()[1:] + entry.key.id()
+        manifest[path] = (entry.size, entry.updated, entry.digest,
+                          entry.chunk_count)
+    _CacheSet(key, pickle.dumps(manifest, pickle.HIGHEST_PROTOCOL))
+    self._manifest = manifest
+    return manifest
+
+  def GetFileDigest(self, path):
+    info = self._GetManifest().get(_Utf8(path))
+    if info is None:
+      return None
+    return info[2]
+
+  def GetFileSize(self, path):
+    info = self._GetManifest().get(_Utf8(path))
+    if info is None:
       return None
-    return len(contents)
+    return info[0]
 
   def GetFileLastModified(self, path):
-    entity = _AhMimicFile.get_by_id(path, parent=self.root)
-    if entity is None:
+    info = self._GetManifest().get(_Utf8(path))
+    if info is None:
       return None
-    return entity.updated
+    return info[1]
 
   def HasFile(self, path):
     # root always exists, even if there are no files in the tree
     if path == '':  # pylint: disable-msg=C6403
       return True
-    entity = _AhMimicFile.get_by_id(path, parent=self.root)
-    return entity is not None
+    return _Utf8(path) in self._GetManifest()
 
-  @ndb.transactional(xg=True)
-  def MoveFile(self, path, newpath):
-    entity = _AhMimicFile.get_by_id(path, parent=self.root)
-    if entity is None:
+  def _FinishWrite(self, released):
+    """Complete a transactional write.
+
+    Args:
+      released: The blob keys which the write stopped referencing, or None if
+          the write didn't change the tree.
+
+    Returns:
+      True if the tree was changed, False otherwise.
+    """
+    if released is None:
       return False
-    self.SetFile(newpath, entity.GetContents())
-    keys_to_delete = [entity.key]
-    if entity.chunk_keys:
-      keys_to_delete.extend(entity.chunk_keys)
-    ndb.delete_multi(keys_to_delete)
+    _ReleaseBlobRefs(released)
+    self._BumpVersion()
     return True
 
+  def MoveFile(self, path, newpath):
+    return self._FinishWrite(self._MoveFiles({path: newpath}))
+
+  def MovePath(self, path, newpath):
+    return self._FinishWrite(self._MovePath(path, newpath))
+
+  @ndb.transactional
+  def _MovePath(self, path, newpath):
+    path = _Utf8(path).rstrip('/')
+    newpath = _Utf8(newpath).rstrip('/')
+    # a directory can't be moved into itself
+    if not path or not newpath or (newpath + '/').startswith(path + '/'):
+      return None
+    return self._MoveFiles(dict((p, newpath + p[len(path):])
+                                for p in self._FindFiles(path)))
+
+  @ndb.transactional
+  def _MoveFiles(self, moves):
+    """Move files by pointing new entities at their existing contents.
+
+    Args:
+      moves: A dict mapping the full paths of files to their new full paths.
+
+    Returns:
+      The blob keys referenced by files which were replaced at the new paths,
+      or None if none of the files exist.
+    """
+    moves = dict((path, newpath) for path, newpath in moves.iteritems()
+                 if path != newpath)
+    paths = sorted(moves)
+    entities = ndb.get_multi(
+        [ndb.Key(_AhMimicFile, path, parent=self.root) for path in paths])
+    # a file moved onto the old path of another one doesn't replace it
+    replaced = ndb.get_multi(
+        [ndb.Key(_AhMimicFile, newpath, parent=self.root)
+         for newpath in moves.itervalues() if newpath not in moves])
+    new_entities = []
+    removed = []
+    old_chunk_keys = []
+    new_chunk_keys = []
+    for path, entity in zip(paths, entities):
+      if entity is None:
+        continue
+      info = _MakeFileInfo(entity)
+      new_entity = _AhMimicFile(id=moves[path], parent=self.root,
+                                contents=entity.contents,
+                                size=info.size, digest=info.digest,
+                                encoding=entity.encoding, crc32=entity.crc32)
+      for key in entity.chunk_keys:
+        if key.kind() == _AhMimicChunk._get_kind():  # pylint: disable-msg=W0212
+          # files stored before _AhMimicBlob have chunks keyed by their path
+          old_chunk_keys.append(key)
+          key = ndb.Key(_AhMimicChunk, key.id(), parent=new_entity.key)
+          new_chunk_keys.append(key)
+        new_entity.chunk_keys.append(key)
+      new_entities.append(new_entity)
+      removed.append(path)
+    if not new_entities:
+      return None
+    chunks = [_AhMimicChunk(key=key, contents=chunk.contents)
+              for key, chunk in zip(new_chunk_keys,
+                                    ndb.get_multi(old_chunk_keys))]
+    keys = ndb.put_multi(new_entities + chunks)
+    replaced_chunk_keys, released = _ChunkKeys(replaced)
+    keys_to_delete = set(
+        [ndb.Key(_AhMimicFile, path, parent=self.root) for path in removed] +
+        old_chunk_keys + replaced_chunk_keys).difference(keys)
+    ndb.delete_multi(list(keys_to_delete))
+    self._UpdateIndex(added=dict((e.key.id(), _MakeFileInfo(e))
+                                 for e in new_entities), removed=removed)
+    return released
+
   def DeletePath(self, path):
     """Delete files with specified leading path."""
-    normpath = self._NormalizeDirectoryPath(path)
-    keys = ndb.Query(ancestor=self.root).fetch(keys_only=True)
-    keys = [k for k in keys if
-            k.id() == path or
-            (k.string_id() and k.string_id().startswith(normpath)) or
-            k.parent().id() == path or
-            k.parent().id().startswith(normpath)]
-    if not keys:
-      return False
-    ndb.delete_multi(keys)
-    return True
+    return self._FinishWrite(self._DeletePath(path))
+
+  @ndb.transactional
+  def _DeletePath(self, path):
+    """Delete files and their directory index entries.
+
+    Returns:
+      The blob keys referenced by the deleted files, or None if there were no
+      files to delete.
+    """
+    paths = self._FindFiles(path)
+    if not paths:
+      return None
+    keys = [ndb.Key(_AhMimicFile, p, parent=self.root) for p in paths]
+    chunk_keys, released = _ChunkKeys(ndb.get_multi(keys))
+    ndb.delete_multi(keys + chunk_keys)
+    self._UpdateIndex(removed=paths)
+    return released
 
   def Clear(self):
+    _, released = _ChunkKeys(_AhMimicFile.query(ancestor=self.root))
+    # includes the directory index
     keys = ndb.Query(ancestor=self.root).fetch(keys_only=True)
     ndb.delete_multi(keys)
+    _ReleaseBlobRefs(released)
+    self._BumpVersion()
 
-  @ndb.transactional
-  def _SetFileChunks(self, path, contents, updated=None):
-    """Put individual file chunks."""
-    chunk_keys = []
+  def _NewFiles(self, files):
+    """Create file entities, storing their contents in the blob store.
+
+    Args:
+      files: List of (path, contents, last_updated) tuples.
+
+    Returns:
+      A list of _AhMimicFile entities which have not been put yet.
+    """
+    encoded = [_Encode(contents) for _, contents, _ in files]
+    keys_list = _AddBlobRefsAsync(
+        [chunks for chunks, _ in encoded]).get_result()
     entities = []
-    index = 1
-    for chunk in _SplitByLength(contents, MAX_BYTES_FOR_ENTITY):
-
-      # The chunk might be OK without having the _AhMimicFile entity
-      # as a parent so that we can rename the file without moving the
-      # actual chunks. However, doing so forces us to retrieve the
-      # chunks property (instead of the keys only query) when
-      # deleting.
-      chunk_key = ndb.Key(pairs=[(self.root.kind(), self.root.id()),
-                                 (_AhMimicFile, path),
-                                 (_AhMimicChunk, index)],
-                          namespace=self.root.namespace())
-      chunk_keys.append(chunk_key)
-      entities.append(_AhMimicChunk(key=chunk_key, contents=chunk))
-      index += 1
-    entities.append(_AhMimicFile(id=path, parent=self.root,
-                                 chunk_keys=chunk_keys, updated=None))
-    ndb.put_multi(entities)
+    for (path, contents, updated), (_, encoding), keys in zip(files, encoded,
+                                                              keys_list):
+      entity = _AhMimicFile(id=path, parent=self.root, chunk_keys=keys,
+                            updated=updated, size=len(contents),
+                            digest=_Digest(contents), encoding=encoding)
+      if encoding:
+        entity.crc32 = zlib.crc32(contents) & 0xffffffff
+      entities.append(entity)
+    return entities
 
   def SetFile(self, path, contents):
-    if len(contents) > MAX_BYTES_FOR_ENTITY:
-      self._SetFileChunks(path, contents)
-    else:
-      entity = _AhMimicFile(id=path, parent=self.root, contents=contents)
-      entity.put()
+    entity, = self._NewFiles([(path, contents, None)])
+    _ReleaseBlobRefs(self._SetFile(entity))
+    self._BumpVersion()
+
+  @ndb.transactional
+  def _SetFile(self, entity):
+    """Put a file entity, returning the blob keys of the file it replaced."""
+    chunk_keys, released = _ChunkKeys([entity.key.get()])
+    entity.put()
+    ndb.delete_multi(chunk_keys)
+    self._UpdateIndex(added={entity.key.id(): _MakeFileInfo(entity)})
+    return released
+
+  def _DirectoryKey(self, prefix):
+    return ndb.Key(_AhMimicDirectory, '/' + _Utf8(prefix), parent=self.root)
+
+  def _EntryKey(self, prefix, name, is_file):
+    """Returns the _AhMimicDirectoryEntry key of a file or subdirectory."""
+    if not is_file:
+      name += '/'
+    return ndb.Key(_AhMimicDirectoryEntry, name,
+                   parent=self._DirectoryKey(prefix))
+
+  def _EntryQuery(self, prefix):
+    """Returns a query for the entries of the directory with prefix."""
+    return _AhMimicDirectoryEntry.query(ancestor=self._DirectoryKey(prefix))
+
+  def _GetEntryKeys(self, path, limit=None):
+    """Returns the _AhMimicDirectoryEntry keys of a directory path."""
+    prefix = self._NormalizeDirectoryPath(_Utf8(path))
+    keys = self._EntryQuery(prefix).fetch(limit, keys_only=True)
+    if not keys and self._RebuildIndexIfMissing():
+      keys = self._EntryQuery(prefix).fetch(limit, keys_only=True)
+    return keys
+
+  def _RebuildIndexIfMissing(self):
+    """Build the directory index for trees that were stored without one.
+
+    Returns:
+      True if the index was rebuilt, False otherwise.
+    """
+    if self._index_checked:
+      return False
+    self._index_checked = True
+    if self._EntryQuery('').get(keys_only=True) is not None:
+      return False
+    added = {}
+    for entity in _AhMimicFile.query(ancestor=self.root):
+      added[entity.key.id()] = _MakeFileInfo(entity)
+    if not added:
+      return False
+    paths = sorted(added)
+    for batch in _SplitByLength(paths, MAX_FILES_PER_TRANSACTION):
+      self._UpdateIndex(added=dict((path, added[path]) for path in batch))
+    return True
+
+  @ndb.transactional
+  def _UpdateIndex(self, added=None, removed=()):
+    """Update the directory index for added and removed files.
+
+    Every write of file entities calls this within its own transaction, so
+    that the index, and the manifest built from it, never miss a stored file.
+    Only the entries of the files, and of the directories which they create or
+    empty, are written.
+
+    Args:
+      added: A dict mapping the full paths of files which were created or
+          updated to their _AhMimicDirectoryEntry.
+      removed: The full paths of files which were deleted.
+    """
+    added = added or {}
+    entities = {}
+    for path, info in added.iteritems():
+      for prefix, name, is_file in _IndexEntries(path):
+        key = self._EntryKey(prefix, name, is_file)
+        if is_file:
+          info.key = key
+          entities[key] = info
+        elif key not in entities:
+          entities[key] = _AhMimicDirectoryEntry(key=key)
+
+    # the entries to delete, by the key of their directory
+    deleted = {}
+    prefixes = set()
+    for path in removed:
+      entries = _IndexEntries(path)
+      prefix, name, _ = entries[-1]
+      key = self._EntryKey(prefix, name, True)
+      if key not in entities:
+        deleted.setdefault(key.parent(), set()).add(key)
+        prefixes.update(p for p, _, _ in entries)
+    # deepest directories first, so that emptied directories are pruned all
+    # the way up (queries don't see the writes of their own transaction)
+    kept = set(key.parent() for key in entities)
+    for prefix in sorted(prefixes, key=len, reverse=True):
+      directory_key = self._DirectoryKey(prefix)
+      if not prefix or directory_key in kept or directory_key not in deleted:
+        continue
+      keys = self._EntryQuery(prefix).fetch(len(deleted[directory_key]) + 1,
+                                            keys_only=True)
+      if set(keys).difference(deleted[directory_key]):
+        continue
+      parent, name = _ParentPrefix(prefix)
+      key = self._EntryKey(parent, name, False)
+      deleted.setdefault(key.parent(), set()).add(key)
+    ndb.put_multi(entities.values())
+    ndb.delete_multi(list(itertools.chain(*deleted.values())))
+
+  def _FindFiles(self, path):
+    """Returns the full paths of a file, or all files below a directory."""
+    self._RebuildIndexIfMissing()
+    paths = []
+    parent, name = _ParentPrefix(_Utf8(path) + '/')
+    if self._EntryKey(parent, name, True).get() is not None:
+      paths.append(parent + name)
+    prefixes = [self._NormalizeDirectoryPath(_Utf8(path))]
+    while prefixes:
+      # the directories of each level are listed concurrently
+      futures = [self._EntryQuery(prefix).fetch_async(keys_only=True)
+                 for prefix in prefixes]
+      subprefixes = []
+      for prefix, future in zip(prefixes, futures):
+        for key in future.get_result():
+          if _IsFileEntry(key):
+            paths.append(prefix + key.id())
+          else:
+            subprefixes.append(prefix + key.id())
+      prefixes = subprefixes
+    return paths
 
   def HasDirectory(self, path):
     path = self._NormalizeDirectoryPath(path)
     # always return True for root, even if tree is empty
     if path == '/':
       return True
-    for key in _AhMimicFile.query(ancestor=self.root).iter(keys_only=True):
-      if key.id().startswith(path):
-        return True
-    return False
+    return bool(self._GetEntryKeys(path, limit=1))
 
   def ListDirectory(self, path):
     """Enumerate directory contents with leading path."""
-    path = self._NormalizeDirectoryPath(path)
-    # TODO: optimize by using a more structured tree representation
-    keys = _AhMimicFile.query(ancestor=self.root).iter(keys_only=True)
-    paths = set()
-    for key in keys:
-      entry_path = key.id()
-      # 'path is None' means get all files recursively
-      if path is None:
-        paths.add(entry_path)
-        continue
-      if not entry_path.startswith(path):
-        continue
-      tail = entry_path[len(path):]
-      # return tail if tail is a file otherwise return dir name (=first segment)
-      subpath = tail.split('/', 1)[0]
-      paths.add(subpath)
-    return sorted(paths)
+    # 'path is None' means get all files recursively
+    if path is None:
+      return sorted(self._GetManifest())
+    return sorted(set(_EntryName(key) for key in self._GetEntryKeys(path)))
 
   def GetFiles(self, path):
     """Retrieve files in the tree with leading path.
@@ -201,13 +931,19 @@ class DatastoreTree(common.Tree):
       the tree.
     """
     path = self._NormalizeDirectoryPath(path)
-    # TODO: optimize by using a more structured tree representation
+
+    # the contents of every file are fetched concurrently, in batches, while
+    # the query is still returning further files
+    @ndb.tasklet
+    def GetFile(entity):
+      if path is not None and not entity.key.id().startswith(path):
+        raise ndb.Return(None)
+      contents = yield entity.GetContentsAsync()
+      raise ndb.Return((entity.key.id(), contents, entity.updated))
+
     query = _AhMimicFile.query(ancestor=self.root)
-    files = query.fetch(batch_size=100, deadline=20)
-    if path is not None:
-      files = [f for f in files if f.key.id().startswith(path)]
-    # TODO: use tasklets to handle async fetching of chunks
-    return [(f.key.id(), f.GetContents(), f.updated) for f in files]
+    files = query.map(GetFile, batch_size=100, deadline=20)
+    return [f for f in files if f is not None]
 
   def PutFiles(self, files):
     """Store files in the tree.
@@ -215,14 +951,59 @@ class DatastoreTree(common.Tree):
     Args:
       files: List of (path, contents, last_updated) tuples.
     """
-    entities = []
-    for path, contents, updated in files:
-      if len(contents) > MAX_BYTES_FOR_ENTITY:
-        # TODO: use tasklets to handle async putting of chunks
-        self._SetFileChunks(path=path, contents=contents, updated=updated)
-      else:
-        entity = _AhMimicFile(id=path, parent=self.root, contents=contents,
-                              updated=updated)
-        entities.append(entity)
+    entities = self._NewFiles(files)
+    released = []
+    for batch in _SplitByLength(entities, MAX_FILES_PER_TRANSACTION):
+      released.extend(self._PutFiles(batch))
+    _ReleaseBlobRefs(released)
+    self._BumpVersion()
+
+  @ndb.transactional
+  def _PutFiles(self, entities):
+    """Put file entities along with their directory index entries.
+
+    Returns:
+      The blob keys referenced by the files which were replaced.
+    """
+    chunk_keys, released = _ChunkKeys(
+        ndb.get_multi([entity.key for entity in entities]))
     ndb.put_multi(entities)
+    ndb.delete_multi(chunk_keys)
+    self._UpdateIndex(added=dict(
+        (entity.key.id(), _MakeFileInfo(entity)) for entity in entities))
+    return released
+
+  def BackfillMetadata(self):
+    """Backfill the size and digest of files which lack them.
 
+    The entities are updated through the datastore API rather than ndb, so
+    that the auto_now updated property keeps its value.
+
+    Returns:
+      The number of file entities which were updated.
+    """
+    count = 0
+    batch = []
+    query = _AhMimicFile.query(ancestor=self.root)
+    for entity in query.iter(batch_size=100):
+      if entity.size is not None and entity.digest is not None:
+        continue
+      contents = entity.GetContents()
+      raw = datastore.Get(entity.key.to_old_key())
+      raw['size'] = len(contents)
+      raw['digest'] = _Digest(contents)
+      raw.set_unindexed_properties(set(raw.unindexed_properties()) |
+                                   set(['size', 'digest']))
+      batch.append(raw)
+      if len(batch) == 100:
+        datastore.Put(batch)
+        count += len(batch)
+        batch = []
+    if batch:
+      datastore.Put(batch)
+      count += len(batch)
+    if count:
+      # ndb's context cache still holds the entities without metadata
+      ndb.get_context().clear_cache()
+      self._BumpVersion()
+    return count
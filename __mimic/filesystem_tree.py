@@ -1,11 +1,42 @@
 """An immutable tree implementation that is backed by the filesystem."""
 
+import collections
 import datetime
+import hashlib
 import logging
 import os
 
 from . import common
 
+# The size of the chunks returned by GetFileChunks().
+READ_BYTES = 65536  # 64 kbytes
+
+# Digests of files by (path, mtime, size), least recently used first, so that
+# a file is only read again once it changes, see GetFileDigest().
+_digests = collections.OrderedDict()
+
+# Maximum number of digests kept in _digests
+_MAX_CACHED_DIGESTS = 1000
+
+
+def _ReadChunks(fh, start, end):
+  """Yields chunks read from an open file, closing it when done."""
+  try:
+    fh.seek(start)
+    remaining = end - start if end is not None else None
+    while remaining is None or remaining > 0:
+      if remaining is None:
+        data = fh.read(READ_BYTES)
+      else:
+        data = fh.read(min(READ_BYTES, remaining))
+        remaining -= len(data)
+      if not data:
+        return
+      yield data
+  finally:
+    fh.close()
+
+
 class FilesystemTree(common.Tree):
   """An implementation of Tree backed by the filesystem."""
 
@@ -30,10 +61,33 @@ class FilesystemTree(common.Tree):
     with open(path) as fh:
       return fh.read()
 
+  def GetFileChunks(self, path, start=0, end=None):
+    path = os.path.join(self.repo_path, path)
+    # open eagerly, so that a missing file raises here like GetFileContents
+    return _ReadChunks(open(path, 'rb'), start, end)
+
   def GetFileSize(self, path):
     path = os.path.join(self.repo_path, path)
     return os.path.getsize(path)
 
+  def GetFileDigest(self, path):
+    full_path = os.path.join(self.repo_path, path)
+    try:
+      stat = os.stat(full_path)
+    except OSError:
+      return None
+    key = (full_path, stat.st_mtime, stat.st_size)
+    digest = _digests.pop(key, None)
+    if digest is None:
+      sha1 = hashlib.sha1()
+      for chunk in self.GetFileChunks(path):
+        sha1.update(chunk)
+      digest = sha1.hexdigest()
+      if len(_digests) >= _MAX_CACHED_DIGESTS:
+        _digests.popitem(last=False)
+    _digests[key] = digest
+    return digest
+
   def GetFileLastModified(self, path):
     path = os.path.join(self.repo_path, path)
     mtime = os.path.getmtime(path)
@@ -25,6 +25,7 @@ in a pristine environment, so measures are taken not to invoke any sort of
 WSGI framework until it is determined that the request is a control request.
 """
 
+import collections
 import httplib
 import logging
 import os
@@ -65,65 +66,134 @@ _NOT_FOUND_PAGE = """
 # store most recently seen project_id (dev_appserver only)
 _dev_appserver_state = {}
 
+# most recently used target_info.AppConfig of each namespace, along with the
+# digest of the app.yaml it was built from, least recently used first
+_app_configs = collections.OrderedDict()
+
+# Maximum number of namespaces in _app_configs
+_MAX_APP_CONFIGS = 100
+
 
 def RespondWithStatus(status_code, expiration_s=0,
                       content_type='text/plain; charset=utf-8',
-                      data=None, headers=None):
-  """Respond with a status code and optional text/plain; charset=utf-8 data."""
-  print 'Content-Type: %s' % content_type
-  print 'Status: %d %s' % (status_code, httplib.responses[status_code])
+                      data=None, headers=None, start_response=None):
+  """Respond with a status code and optional text/plain; charset=utf-8 data.
+
+  The response is printed in CGI format, unless a WSGI start_response callable
+  is given, in which case the status and headers are passed to it and the
+  body is returned for the WSGI server to send.
+
+  Args:
+    status_code: The numeric HTTP status code.
+    expiration_s: The number of seconds the response may be cached for.
+    content_type: The Content-Type of the response.
+    data: The body of the response as a string, an iterable of strings, or
+        None for no body.
+    headers: A list of additional (name, value) header tuples.
+    start_response: A WSGI start_response callable, or None to print the
+        response.
+
+  Returns:
+    An iterable of strings with the body when start_response is given,
+    otherwise None.
+  """
+  status = '%d %s' % (status_code, httplib.responses[status_code])
+  response_headers = []
   if expiration_s:
-    print 'Expires: %s' % rfc822.formatdate(time.time() + expiration_s)
-    print 'Cache-Control: public, max-age=%s' % expiration_s
+    response_headers.append(
+        ('Expires', rfc822.formatdate(time.time() + expiration_s)))
+    response_headers.append(
+        ('Cache-Control', 'public, max-age=%s' % expiration_s))
   if headers:
-    for k, v in headers:
+    response_headers.extend(headers)
+  if isinstance(data, str):
+    body = [data]
+  else:
+    body = data or []
+  if start_response is None:
+    print 'Content-Type: %s' % content_type
+    print 'Status: %s' % status
+    for k, v in response_headers:
       print '{0}: {1}'.format(k, v)
-  print ''
-  if data is not None:
-    print data,
+    print ''
+    for chunk in body:
+      sys.stdout.write(chunk)
+    return None
+  # headers may override the default Content-Type
+  if not any(k.lower() == 'content-type' for k, _ in response_headers):
+    response_headers.insert(0, ('Content-Type', content_type))
+  if isinstance(data, str):
+    response_headers.append(('Content-Length', str(len(data))))
+  start_response(status, response_headers)
+  return body
 
 
-def ServeStaticPage(tree, page):
+def _GetRequestHeader(name):
+  """Returns the value of a CGI request header, or None."""
+  return os.environ.get('HTTP_' + name.upper().replace('-', '_'))
+
+
+def ServeStaticPage(tree, page, start_response=None):
   """Respond by serving a single static file.
 
   Args:
     tree: A tree object to use to retrieve files.
     page: A StaticPage object describing the file to be served.
+    start_response: A WSGI start_response callable, see RespondWithStatus().
+
+  Returns:
+    The body of the response, see RespondWithStatus().
   """
   file_path = page.file_path
   logging.info('Serving static page %s', file_path)
-  file_data = tree.GetFileContents(file_path)
-  if file_data is None:
-    RespondWithStatus(httplib.NOT_FOUND,
-                      content_type='text/html; charset=utf-8',
-                      data=_NOT_FOUND_PAGE % file_path)
-    return
+  response = common.GetFileResponse(tree, file_path, _GetRequestHeader)
+  if response is None:
+    return RespondWithStatus(httplib.NOT_FOUND,
+                             content_type='text/html; charset=utf-8',
+                             data=_NOT_FOUND_PAGE % file_path,
+                             start_response=start_response)
+  status_code, headers, file_data = response
   if page.mime_type is not None:
     content_type = page.mime_type
   else:
     content_type = common.GuessMimeType(file_path)
   # should not raise ConfigurationError, but even that would be ok
   expiration_s = appinfo.ParseExpiration(page.expiration)
-  RespondWithStatus(httplib.OK, content_type=content_type,
-                    data=file_data, expiration_s=expiration_s)
+  return RespondWithStatus(status_code, content_type=content_type,
+                           data=file_data, expiration_s=expiration_s,
+                           headers=headers, start_response=start_response)
 
 
-def ServeScriptPage(tree, config, page, namespace):
+def ServeScriptPage(tree, config, page, namespace, environ=None,
+                    start_response=None):
   """Respond by invoking a python cgi script.
 
+  A CGI script always prints its response.  With start_response, a "native"
+  WSGI application is called directly and its body is streamed back, see
+  target_env.TargetEnvironment.RunScript().
+
   Args:
     tree: A tree object to use to retrieve files.
-    config: The app's config loaded from the app's app.yaml.
+    config: The app's target_info.AppConfig.
     page: A ScriptPage object describing the file to be served.
     namespace: The datastore and memcache namespace used for metadata.
+    environ: The WSGI environ of the request, required with start_response.
+    start_response: A WSGI start_response callable, see RespondWithStatus().
+
+  Returns:
+    The body of the response, see RespondWithStatus(), or None if the script
+    printed its response.
   """
   logging.info('Serving script page %s', page.script_path)
-  env = target_env.TargetEnvironment(tree, config, namespace)
+  env = target_env.GetTargetEnvironment(tree, config, namespace)
   try:
-    env.RunScript(page.script_path, control.LoggingHandler(namespace))
+    return env.RunScript(page.script_path, control.LoggingHandler(namespace),
+                         environ=environ, start_response=start_response)
   except target_env.ScriptNotFoundError:
-    RespondWithStatus(httplib.NOT_FOUND,
-                      data='Error: could not find script %s' % page.script_path)
+    return RespondWithStatus(
+        httplib.NOT_FOUND,
+        data='Error: could not find script %s' % page.script_path,
+        start_response=start_response)
 
 
 def _IsAuthorized(page, users_mod):
@@ -166,46 +236,83 @@ def _CurrentUrl(force_https=False):
   return url
 
 
-def RunTargetApp(tree, path_info, namespace, users_mod):
-  """Top level handling of target application requests.
+def _GetAppConfig(tree, namespace):
+  """Get the validated config of the target app.
+
+  The config is only parsed and validated again when the digest of app.yaml
+  changes, so steady-state requests skip both.
 
   Args:
     tree: A tree object to use to retrieve files.
-    path_info: The path to be served.
     namespace: The datastore and memcache namespace used for metadata.
-    users_mod: A users module to use for authentication.
+
+  Returns:
+    A (target_info.AppConfig, None) tuple, or (None, error message) if app.yaml
+    is missing or cannot be parsed.
+
+  Raises:
+    target_info.ValidationError: if the app.yaml data is invalid.
   """
+  digest = tree.GetFileDigest('app.yaml')
+  if digest is None:
+    return None, 'Error: no app.yaml file.'
+  cached = _app_configs.pop(namespace, None)
+  if cached is not None and cached[0] == digest:
+    _app_configs[namespace] = cached
+    return cached[1], None
   app_yaml = tree.GetFileContents('app.yaml')
   if app_yaml is None:
-    RespondWithStatus(httplib.NOT_FOUND, data='Error: no app.yaml file.')
-    return
+    return None, 'Error: no app.yaml file.'
   try:
     config = yaml.safe_load(app_yaml)
   except yaml.YAMLError:
-    errmsg = ('Error: app.yaml configuration is missing or invalid: {0}'
-              .format(sys.exc_info()[1]))
-    RespondWithStatus(httplib.NOT_FOUND, data=errmsg)
-    return
+    return None, ('Error: app.yaml configuration is missing or invalid: {0}'
+                  .format(sys.exc_info()[1]))
   # bail if yaml.safe_load fails to return dict due to malformed yaml input
   if not isinstance(config, dict):
-    errmsg = 'Error: app.yaml configuration is missing or invalid.'
-    RespondWithStatus(httplib.NOT_FOUND, data=errmsg)
-    return
-  page = target_info.FindPage(config, path_info)
+    return None, 'Error: app.yaml configuration is missing or invalid.'
+  app_config = target_info.AppConfig(config)
+  if len(_app_configs) >= _MAX_APP_CONFIGS:
+    _app_configs.popitem(last=False)
+  _app_configs[namespace] = (digest, app_config)
+  return app_config, None
+
+
+def RunTargetApp(tree, path_info, namespace, users_mod, environ=None,
+                 start_response=None):
+  """Top level handling of target application requests.
+
+  Args:
+    tree: A tree object to use to retrieve files.
+    path_info: The path to be served.
+    namespace: The datastore and memcache namespace used for metadata.
+    users_mod: A users module to use for authentication.
+    environ: The WSGI environ of the request, required with start_response.
+    start_response: A WSGI start_response callable, see RespondWithStatus().
+
+  Returns:
+    The body of the response, see RespondWithStatus(), or None if the
+    response was printed.
+  """
+  app_config, errmsg = _GetAppConfig(tree, namespace)
+  if app_config is None:
+    return RespondWithStatus(httplib.NOT_FOUND, data=errmsg,
+                             start_response=start_response)
+  page = app_config.FindPage(path_info)
 
   if not page:
-    RespondWithStatus(httplib.NOT_FOUND,
-                      content_type='text/html; charset=utf-8',
-                      data=_NOT_FOUND_PAGE % path_info)
-    return
+    return RespondWithStatus(httplib.NOT_FOUND,
+                             content_type='text/html; charset=utf-8',
+                             data=_NOT_FOUND_PAGE % path_info,
+                             start_response=start_response)
 
   # in production redirect to https for handlers specifying 'secure: always'
   if (page.secure == target_info.SECURE_ALWAYS
       and not common.IsDevMode()
       and os.environ['wsgi.url_scheme'] != 'https'):
     https_url = _CurrentUrl(force_https=True)
-    RespondWithStatus(httplib.FOUND, headers=[('Location', https_url)])
-    return
+    return RespondWithStatus(httplib.FOUND, headers=[('Location', https_url)],
+                             start_response=start_response)
 
   if not _IsAuthorized(page, users_mod):
     user = users_mod.get_current_user()
@@ -218,14 +325,16 @@ def RunTargetApp(tree, path_info, namespace, users_mod):
       url = users_mod.create_login_url(_CurrentUrl())
       message = ('You are not authorized to view this page. '
                  'You may need to <a href="{0}">login</a>.'.format(url))
-    RespondWithStatus(httplib.FORBIDDEN, data=message,
-                      headers=[('Content-Type', 'text/html; charset=utf-8')])
-    return
+    return RespondWithStatus(
+        httplib.FORBIDDEN, data=message,
+        headers=[('Content-Type', 'text/html; charset=utf-8')],
+        start_response=start_response)
   # dispatch the page
   if isinstance(page, target_info.StaticPage):
-    ServeStaticPage(tree, page)
+    return ServeStaticPage(tree, page, start_response)
   elif isinstance(page, target_info.ScriptPage):
-    ServeScriptPage(tree, config, page, namespace)
+    return ServeScriptPage(tree, app_config, page, namespace, environ,
+                           start_response)
   else:
     raise NotImplementedError('Unrecognized page {0!r}'.format(page))
 
@@ -355,14 +464,27 @@ def GetNamespace():
   return namespace
 
 
-def RunMimic(create_tree_func, access_key, users_mod=users):
+def RunMimic(create_tree_func, access_key, users_mod=users, environ=None,
+             start_response=None):
   """Entry point for mimic.
 
+  By default the response is printed in CGI format. When called from a WSGI
+  application, pass its environ and start_response instead, so that responses
+  generated by mimic itself are handed directly to the WSGI server. Responses
+  from target scripts are still printed.
+
   Args:
     create_tree_func: A callable that creates a common.Tree.
     access_key: Key which grants access to the tree
     users_mod: A users module to use for authentication (default is the
         AppEngine users module).
+    environ: The WSGI environ of the request, required with start_response.
+    start_response: The WSGI start_response callable, or None to print the
+        response.
+
+  Returns:
+    An iterable of strings with the body of the response, or None if the
+    response was printed.
   """
   # use PATH_INFO to determine if this is a control or target request
   path_info = os.environ['PATH_INFO']
@@ -393,11 +515,17 @@ def RunMimic(create_tree_func, access_key, users_mod=users):
       tree = None
 
     if is_control_request:
-      run_wsgi_app(control.MakeControlApp(tree, namespace))
+      app = control.MakeControlApp(tree, namespace)
     elif path_info.startswith(common.SHELL_PREFIX):
-      run_wsgi_app(shell.MakeShellApp(tree, namespace))
+      app = shell.MakeShellApp(tree, namespace)
     else:
-      RunTargetApp(tree, path_info, namespace, users_mod)
+      return RunTargetApp(tree, path_info, namespace, users_mod, environ,
+                          start_response)
+    if start_response is None:
+      run_wsgi_app(app)
+      return None
+    # webapp2 responses are complete lists, safe to return from here
+    return app(environ, start_response)
   finally:
     # Restore the original namespace
     namespace_manager.set_namespace(saved_namespace)
@@ -20,21 +20,24 @@ manipulation of sys.path_hooks and sys.path (see PEP 302 for details).
 
 
 
+import collections
+import cStringIO
 import errno
 # import gc
 import imp
 import linecache
 import logging
+import operator
 import os
 import re
 import stat
 import string
-import StringIO
 import sys
 import time
 import traceback
 import webapp2
 
+from . import common
 from . import composite_query
 from . import target_errors
 from . import target_info
@@ -58,6 +61,34 @@ except ImportError:
     logging.warning('Could not import posix or nt, os.stat will not be '
                     'available to the target app!')
 
+# Compiled code objects of target modules, keyed by _CodeCacheKey(), oldest
+# first.  Modules are discarded after every request, but their code is not.
+_code_cache = collections.OrderedDict()
+
+# Maximum number of code objects kept in _code_cache
+_MAX_CACHED_CODE_OBJECTS = 1000
+
+# Classes of paths, see TargetEnvironment._ClassifyPath()
+_PATH_OK = 0
+_PATH_STATIC = 1
+_PATH_SKIPPED = 2
+
+# Maximum number of paths remembered by TargetEnvironment._ClassifyPath()
+_MAX_CLASSIFIED_PATHS = 1000
+
+# Warm TargetEnvironments by namespace, least recently used first, see
+# GetTargetEnvironment()
+_warm_environments = collections.OrderedDict()
+
+# sys.modules as it is outside of target environments, shared by all of them
+# instead of copied for every request
+_baseline_modules = {}
+
+# Fetches the _baseline_modules entries from a dict as a tuple, and the
+# values it returns for _baseline_modules, see _ChangedBaselineModules()
+_baseline_getter = None
+_baseline_values = ()
+
 # Mount point for the virtual target file system
 _TARGET_ROOT = '/target'
 _TARGET_PREFIX = _TARGET_ROOT + '/'
@@ -203,6 +234,31 @@ def _MakeStatResult(mode, size=0, mtime=None):
   return _stat_result(stats)
 
 
+def _CodeCacheKey(namespace, file_path, digest):
+  """Returns the cache key for the code compiled from a target file.
+
+  Code is only ever shared within a project, and is kept in process memory
+  only: anything stored in memcache or the datastore could be written by target
+  code, which would then run in every project loading it.
+
+  Args:
+    namespace: The project's namespace.
+    file_path: The path of the file in the tree.
+    digest: The digest of the file's contents.
+
+  Returns:
+    A tuple.
+  """
+  return (namespace, imp.get_magic(), digest, file_path)
+
+
+def _CacheCode(key, code):
+  """Add a code object to _code_cache, evicting the oldest if it is full."""
+  if len(_code_cache) >= _MAX_CACHED_CODE_OBJECTS:
+    _code_cache.popitem(last=False)
+  _code_cache[key] = code
+
+
 # TODO: File is currently patched in such a way that if the
 # user opens up a non-target file the resulting object is not an
 # instance of MimicFile and thus wouldn't pass a check of:
@@ -214,10 +270,14 @@ def _MakeStatResult(mode, size=0, mtime=None):
 # then wouldn't be checked as instances of file.
 
 
-# MimicFile inherits from object first in order to make it a new-style
-# class so that __new__ will work as expected.
-class MimicFile(object, StringIO.StringIO):
-  """A class that represents target files in Mimic."""
+class MimicFile(object):
+  """A class that represents target files in Mimic.
+
+  Reading is delegated to a cStringIO object, which reads the contents
+  returned by the tree in place instead of copying them, and is implemented in
+  C unlike StringIO.  Its methods are bound to the instance directly, so that
+  calling them costs no more than calling them on the cStringIO object.
+  """
 
   def __new__(cls, *args, **kwargs):
     # This is essentially a virtual constructor, dispatching depending on
@@ -242,7 +302,10 @@ class MimicFile(object, StringIO.StringIO):
       raise IOError(errno.ENOENT, "No such file or directory: '%s'" % filename)
     if 'U' in mode:
       contents = _ConvertNewlines(contents)
-    StringIO.StringIO.__init__(self, contents)
+    self._buffer = cStringIO.StringIO(contents)
+    for name in ('close', 'flush', 'getvalue', 'isatty', 'read', 'readline',
+                 'readlines', 'seek', 'tell'):
+      setattr(self, name, getattr(self._buffer, name))
 
   def __repr__(self):
     return """<open {} '{}', mode '{}'>""".format(self.__class__.__name__,
@@ -253,11 +316,21 @@ class MimicFile(object, StringIO.StringIO):
     return self
 
   def __exit__(self, unused_type, unused_value, unused_traceback):
-    # Release StringIO memory buffer.
+    # Release the reference to the contents.
     self.close()
     # Allow exceptions to propagate.
     return False
 
+  def __iter__(self):
+    return self
+
+  def next(self):
+    return self._buffer.next()
+
+  @property
+  def closed(self):
+    return self._buffer.closed
+
   # override methods that would allow modification of the file
 
   def write(self, unused_data):
@@ -270,6 +343,57 @@ class MimicFile(object, StringIO.StringIO):
     raise IOError('File is read-only')
 
 
+def _SyncBaselineModules():
+  """Return _baseline_modules, updated if needed to match sys.modules.
+
+  Target environments restore sys.modules to the baseline when they are
+  removed, and once an instance has warmed up mimic rarely imports anything
+  outside of them.  So a copy of sys.modules is only taken again when a
+  module was added, removed or replaced since, rather than for every request.
+
+  Returns:
+    The baseline dict, which may be updated by the caller.
+  """
+  if (len(_baseline_modules) != len(sys.modules) or
+      _ChangedBaselineModules()):
+    _baseline_modules.clear()
+    _UpdateBaselineModules(sys.modules)
+  return _baseline_modules
+
+
+def _UpdateBaselineModules(modules):
+  """Add modules, a dict, to _baseline_modules."""
+  global _baseline_getter, _baseline_values  # pylint: disable-msg=W0603
+  _baseline_modules.update(modules)
+  names = list(_baseline_modules)
+  # itemgetter() only returns a tuple for two names or more
+  if len(names) > 1:
+    _baseline_getter = operator.itemgetter(*names)
+    _baseline_values = _baseline_getter(_baseline_modules)
+  else:
+    _baseline_getter = None
+
+
+def _ChangedBaselineModules():
+  """Return the names whose sys.modules entry is not the baseline module.
+
+  This includes names that were removed from sys.modules.  Usually nothing
+  changed, which a single comparison made in C confirms.  Modules do not
+  define __eq__, so the comparison is by identity.
+
+  Returns:
+    A list of names in _baseline_modules.
+  """
+  if _baseline_getter is not None:
+    try:
+      if _baseline_getter(sys.modules) == _baseline_values:
+        return []
+    except KeyError:
+      pass  # a module was removed
+  return [name for name, module in _baseline_modules.iteritems()
+          if name not in sys.modules or sys.modules[name] is not module]
+
+
 class _Finder(object):
   """A class finder that is bound to a specific sys.path entry.
 
@@ -316,8 +440,85 @@ class _Loader(object):
     return self.env.LoadModule(self, fullname)
 
 
+class _ResponseBody(object):
+  """The body of a target WSGI application's response, see RunScript().
+
+  The target environment stays installed while the body is produced, and is
+  removed once the body has been consumed or closed.  This is an object rather
+  than a generator because a generator that was never started ignores close(),
+  which would leave the environment installed.
+  """
+
+  def __init__(self, env, body, namespace, logging_handler, saved_level):
+    """Initialize the body.
+
+    Args:
+      env: The TargetEnvironment installed by RunScript().
+      body: The iterable returned by the target WSGI application.
+      namespace: The namespace the application was called in, which is
+          reinstated while each piece of the body is produced.
+      logging_handler: The logging.Handler installed by RunScript().
+      saved_level: The logging level to restore.
+    """
+    self._env = env
+    self._body = body
+    self._namespace = namespace
+    self._logging_handler = logging_handler
+    self._saved_level = saved_level
+    self._closed = False
+
+  def __iter__(self):
+    """Yield the strings of the body, then remove the target environment.
+
+    Raises:
+      TargetAppError: if producing the body fails.
+    """
+    try:
+      iterator = iter(self._body)
+      while True:
+        saved_namespace = namespace_manager.get_namespace()
+        namespace_manager.set_namespace(self._namespace)
+        try:
+          data = iterator.next()
+        except StopIteration:
+          return
+        except Exception:
+          raise self._env._MakeTargetAppError()  # pylint: disable-msg=W0212
+        finally:
+          namespace_manager.set_namespace(saved_namespace)
+        yield data
+    finally:
+      self.close()
+
+  def close(self):  # pylint: disable-msg=C6409
+    """Close the application's body and remove the target environment."""
+    if self._closed:
+      return
+    self._closed = True
+    try:
+      # PEP 333: close() must be called however the iteration ended
+      if hasattr(self._body, 'close'):
+        self._body.close()
+    finally:
+      # pylint: disable-msg=W0212
+      self._env._Finish(self._logging_handler, self._saved_level)
+
+  def __del__(self):
+    # a body dropped without being closed must not keep the environment
+    self.close()
+
+
 class TargetEnvironment(object):
-  """An environment for the execution of target scripts."""
+  """An environment for the execution of target scripts.
+
+  Installing an environment patches builtins, the os module and sys.modules
+  for the whole process, so at most one can be active at a time and target
+  requests cannot run concurrently within an instance.  Isolating them in
+  worker processes is not an option, since the python27 runtime sandbox does
+  not allow os.fork(), subprocess or multiprocessing.  Concurrency therefore
+  comes from App Engine running more instances, and the per-request cost of an
+  environment is kept down by caches instead (see GetTargetEnvironment()).
+  """
 
   # The currently active TargetEnvironment (there can be at most one)
   _instance = None
@@ -327,17 +528,24 @@ class TargetEnvironment(object):
     """Returns the active TargetEnvironment, or None."""
     return cls._instance
 
-  def __init__(self, tree, config, namespace, test_portal=None):
+  def __init__(self, tree, config, namespace, test_portal=None,
+               keep_modules=False):
     """Initialize and associate with a given tree.
 
     Args:
       tree: A mimic.common.Tree object.
-      config: The app's config loaded from the app's app.yaml.
+      config: The app's config loaded from the app's app.yaml, or a
+          target_info.AppConfig, which keeps the compiled static and skip files
+          patterns for reuse by later environments.
       namespace: The datastore and memcache namespace used for metadata.
       test_portal: An object that can be used to exchange data with target code
           during tests.  If this value is not None, then any loaded modules will
           be initialized with a _test_portal attribute that points to the
           supplied object.
+      keep_modules: If True, the target modules loaded while the environment
+          is installed are kept when it is removed, and installed again along
+          with the environment.  Call Discard() once the environment is no
+          longer needed.
     """
     # throws BadValueError
     namespace_manager.validate_namespace(namespace)
@@ -346,13 +554,43 @@ class TargetEnvironment(object):
     self._active = False
     self._saved_sys_path = None
     self._saved_sys_modules = None
+    # sys.path_importer_cache keys for the finders created by _PathHook()
+    self._finder_paths = []
     self._test_portal = test_portal
+    self._keep_modules = keep_modules
+    self._warm_modules = {}
+    self._tree_version = None
     self._saved_open = open
     self._main_method = ''
     self._wsgi_app_name = None
+    self._environ = None
+    self._start_response = None
+    self._wsgi_response = None
+    # results of FindModule() for the tree version in _module_files_version
+    self._module_files = {}
+    self._module_files_version = None
+    self.find_module_hits = 0
+    self.find_module_misses = 0
+    # results of _GetPathInfo() for the tree version in _path_infos_version
+    self._path_infos = {}
+    self._path_infos_version = None
+    self.path_info_hits = 0
+    self.path_info_misses = 0
+    # the size of _baseline_modules and time taken by the last _TearDown()
+    self.baseline_size = 0
+    self.restore_seconds = 0.0
     self._patches = []
-    self._static_file_patterns = self._CreateStaticFilePatterns(config)
-    self._skip_files_pattern = self._CreateSkipFilesPattern(config)
+    if isinstance(config, target_info.AppConfig):
+      if config.file_patterns is None:
+        config.file_patterns = (self._CreateStaticFilePatterns(config.config),
+                                self._CreateSkipFilesPattern(config.config))
+      self._static_file_patterns, self._skip_files_pattern = (
+          config.file_patterns)
+    else:
+      self._static_file_patterns = self._CreateStaticFilePatterns(config)
+      self._skip_files_pattern = self._CreateSkipFilesPattern(config)
+    # results of _ClassifyPath(), least recently used first
+    self._path_classes = collections.OrderedDict()
 
     # TODO: separate out the patches into separate classes to reduce
     # dependency creep and clean up this class.
@@ -363,7 +601,7 @@ class TargetEnvironment(object):
       self.AddPatch(patch.BuiltinPatch(name, value))
     # patches for the os module
     #
-    # TODO: need to patch lstat, open, readlink, stat, walk
+    # TODO: need to patch open, readlink
     for name, value in [('access', self._Access),
                         ('getcwd', self._GetCwd),
                         ('getcwdu', lambda: unicode(self._GetCwd())),
@@ -372,6 +610,9 @@ class TargetEnvironment(object):
                         ('rename', self._Rename),
                         ('unlink', self._Unlink),
                         ('stat', self._Stat),
+                        # there are no links in the tree
+                        ('lstat', self._Stat),
+                        ('walk', self._Walk),
                        ]:
       self.AddPatch(patch.AttributePatch(os, name, value))
 
@@ -440,13 +681,38 @@ class TargetEnvironment(object):
     Returns:
       True if this path is a static file or directory, False otherwise.
     """
-    if path.startswith(_TARGET_PREFIX):
-      # remove the "application directory"
-      path = path[len(_TARGET_PREFIX):]
-    for path_re in self._static_file_patterns:
-      if path_re.match(path):
-        return True
-    return False
+    return self._ClassifyPath(path) == _PATH_STATIC
+
+  def _ClassifyPath(self, path):
+    """Determines if a path is a static file, a skipped file or neither.
+
+    Target code like template loaders tends to access the same paths over and
+    over, so the results for recently classified paths are remembered.
+
+    Args:
+      path: The path as a string to classify.
+
+    Returns:
+      _PATH_STATIC, _PATH_SKIPPED or _PATH_OK.  Static takes precedence over
+      skipped.
+    """
+    path_class = self._path_classes.pop(path, None)
+    if path_class is None:
+      relative_path = path
+      if relative_path.startswith(_TARGET_PREFIX):
+        # remove the "application directory"
+        relative_path = relative_path[len(_TARGET_PREFIX):]
+      if any(path_re.match(relative_path)
+             for path_re in self._static_file_patterns):
+        path_class = _PATH_STATIC
+      elif self._MatchesSkipFiles(relative_path):
+        path_class = _PATH_SKIPPED
+      else:
+        path_class = _PATH_OK
+      if len(self._path_classes) >= _MAX_CLASSIFIED_PATHS:
+        self._path_classes.popitem(last=False)
+    self._path_classes[path] = path_class
+    return path_class
 
   def _CreateSkipFilesPattern(self, config):
     """Creates a compiled regex to match files that should be skipped.
@@ -485,13 +751,22 @@ class TargetEnvironment(object):
       path: The path as a string to test
 
     Returns:
-      True if this path should be skipped, False otherwise.
+      True if this path should be skipped and is not a static file, False
+      otherwise.
+    """
+    return self._ClassifyPath(path) == _PATH_SKIPPED
+
+  def _MatchesSkipFiles(self, path):
+    """Match path and its parent directories against skip_files.
+
+    Args:
+      path: The path to test, relative to the target root.
+
+    Returns:
+      True if the path or one of its parents is matched by skip_files.
     """
     if not self._skip_files_pattern:
       return False
-    if path.startswith(_TARGET_PREFIX):
-      # remove the target prefix "/target/"
-      path = path[len(_TARGET_PREFIX):]
     while path != os.path.dirname(path):
       if self._skip_files_pattern.match(path):
         return True
@@ -505,42 +780,77 @@ class TargetEnvironment(object):
     """Install the TargetEnvironment (must not already be installed)."""
     assert not self._active
     assert TargetEnvironment._instance is None
-    self._saved_sys_modules = sys.modules.copy()
     self._saved_sys_path = list(sys.path)
-    sys.path.insert(0, _TARGET_ROOT)
-    # The order of path_hooks shouldn't matter.  The only other hook is
-    # going to be the zip importer, which shouldn't interfere with this.
-    # So append rather than insert since it is slightly faster.
-    sys.path_hooks.append(self._PathHook)
-    for p in self._patches:
-      p.Install()
+    installed = []
+    try:
+      self._saved_sys_modules = _SyncBaselineModules()
+      self.baseline_size = len(self._saved_sys_modules)
+      sys.path.insert(0, _TARGET_ROOT)
+      # The order of path_hooks shouldn't matter.  The only other hook is
+      # going to be the zip importer, which shouldn't interfere with this.
+      # So append rather than insert since it is slightly faster.
+      sys.path_hooks.append(self._PathHook)
+      for p in self._patches:
+        p.Install()
+        installed.append(p)
+      self._InstallWarmModules()
+    except:
+      # undo what was done, so that other environments can be installed
+      for p in reversed(installed):
+        p.Remove()
+      if self._PathHook in sys.path_hooks:
+        sys.path_hooks.remove(self._PathHook)
+      sys.path[:] = self._saved_sys_path
+      raise
     self._active = True
     TargetEnvironment._instance = self
 
+  def Discard(self):
+    """Drop the modules kept by an environment created with keep_modules."""
+    assert not self._active
+    self._warm_modules = {}
+    # prevent memory leaks due to cyclic references
+    self._patches = None
+
+  def _InstallWarmModules(self):
+    """Install the modules kept from the last time the environment was used."""
+    for full_name, module in self._warm_modules.iteritems():
+      sys.modules[full_name] = module
+    # link the modules back to packages that were not kept, see
+    # _CleanupModules()
+    for full_name, module in self._warm_modules.iteritems():
+      if '.' in full_name and module is not None:
+        package_name, module_name = full_name.rsplit('.', 1)
+        package = sys.modules.get(package_name)
+        if package_name not in self._warm_modules and package is not None:
+          setattr(package, module_name, module)
+    self._warm_modules = {}
+
   def _TearDown(self):
     """Remove the TargetEnvironment (this call is idempotent)."""
     if not self._active:
       return
     assert TargetEnvironment._instance is self
+    start_time = time.time()
     # Eraddicate user source, which is cached during traceback formatting.
     linecache.clearcache()
     self._CleanupModules()
     # clean up sys.path, which must be modified in place (not replaced)
-    while len(sys.path):
-      sys.path.pop()
-    sys.path.extend(self._saved_sys_path)
+    sys.path[:] = self._saved_sys_path
     # clean up sys.path_importer_cache
-    for p in sys.path_importer_cache.keys():  # pylint: disable-msg=C6401
-      if p == _TARGET_ROOT or p.startswith(_TARGET_PREFIX):
-        del sys.path_importer_cache[p]
+    for p in self._finder_paths:
+      sys.path_importer_cache.pop(p, None)
+    self._finder_paths = []
     sys.path_hooks.remove(self._PathHook)
     for p in self._patches:
       p.Remove()
     self._active = False
+    self.restore_seconds = time.time() - start_time
     TargetEnvironment._instance = None
 
     # prevent memory leaks due to cyclic references
-    self._patches = None
+    if not self._keep_modules:
+      self._patches = None
 
     # tmp = '\n\n'
     # tmp += '\n\nGARBAGE:\n'
@@ -583,19 +893,33 @@ class TargetEnvironment(object):
     # The python interpreter holds onto a reference to sys.modules, so
     # it must be modified in-place.
 
+    # restore mimic modules which user code masked, rebound or removed
+    for full_name in _ChangedBaselineModules():
+      sys.modules[full_name] = self._saved_sys_modules[full_name]
+
+    # Only visit the modules added during the request rather than the several
+    # hundred that are usually loaded (the set difference is computed in C).
+    added = set(sys.modules).difference(self._saved_sys_modules)
+
     # figure out which modules need to be discarded
     dirty = set()
-    for full_name, module in sys.modules.iteritems():
-      # restore mimic modules which may have been masked by user code
-      if full_name in self._saved_sys_modules:
-        sys.modules[full_name] = self._saved_sys_modules[full_name]
-        continue
+    kept = {}
+    for full_name in added:
+      module = sys.modules[full_name]
       # ignore modules that are part of Python
       if (hasattr(module, '__file__') and
           module.__file__.startswith(_PYTHON_LIB_PREFIX)):
+        kept[full_name] = module
         continue
       # need to remove this module
       dirty.add(full_name)
+    if kept:
+      # they stay, so keep the baseline in step with sys.modules
+      _UpdateBaselineModules(kept)
+
+    if self._keep_modules:
+      self._warm_modules = dict((full_name, sys.modules[full_name])
+                                for full_name in dirty)
 
     # get rid of the modules
     for full_name in dirty:
@@ -627,6 +951,7 @@ class TargetEnvironment(object):
   def _PathHook(self, path):
     """A path hook for _TARGET_ROOT and sub directories (see PEP 302)."""
     if path == _TARGET_ROOT or path.startswith(_TARGET_PREFIX):
+      self._finder_paths.append(path)
       return _Finder(self, path)
     else:
       raise ImportError
@@ -649,15 +974,80 @@ class TargetEnvironment(object):
     else:
       subdir = finder.path[len(_TARGET_PREFIX):]
     partial = os.path.join(subdir, fullname.replace('.', '/'))
+    found = self._FindModuleFile(partial)
+    if found is None:
+      return None
+    file_path, is_package = found
+    return _Loader(self, finder.path, file_path, is_package)
+
+  def _FindModuleFile(self, partial):
+    """Find the file of a module in the tree.
+
+    Most imports are of modules that are not in the tree, like the standard
+    library, and an import may be attempted several times.  So the result is
+    remembered for as long as the tree does not change.
+
+    Args:
+      partial: The path of the module, without extension.
+
+    Returns:
+      A (file path, is package) tuple, or None if there is no such module.
+    """
+    version = self._tree.GetVersion()
+    if version != self._module_files_version:
+      self._module_files = {}
+      self._module_files_version = version
+    if partial in self._module_files:
+      self.find_module_hits += 1
+      return self._module_files[partial]
+    self.find_module_misses += 1
+    found = None
     # check for a package
     file_path = partial + '/__init__.py'
     if self._tree.HasFile(file_path):
-      return _Loader(self, finder.path, file_path, True)
-    # check for an individual file
-    file_path = partial + '.py'
-    if self._tree.HasFile(file_path):
-      return _Loader(self, finder.path, file_path, False)
-    return None
+      found = (file_path, True)
+    else:
+      # check for an individual file
+      file_path = partial + '.py'
+      if self._tree.HasFile(file_path):
+        found = (file_path, False)
+    self._module_files[partial] = found
+    return found
+
+  def _GetPathInfo(self, path):
+    """Describe a file or directory in the tree for the patched os functions.
+
+    Target code tends to stat, test and open the same paths repeatedly, so
+    the description is remembered for as long as the tree does not change.
+
+    Args:
+      path: A path resolved by _ResolvePath().
+
+    Returns:
+      A (mode, size, mtime) tuple suitable for _MakeStatResult(), where mode
+      is _FILE_STAT_MODE or _DIR_STAT_MODE, or None if there is no such file
+      or directory.
+    """
+    version = self._tree.GetVersion()
+    if version != self._path_infos_version:
+      self._path_infos = {}
+      self._path_infos_version = version
+    if path in self._path_infos:
+      self.path_info_hits += 1
+      return self._path_infos[path]
+    self.path_info_misses += 1
+    info = None
+    # the root is always a directory, even for an empty tree
+    if not path:
+      info = (_DIR_STAT_MODE, 0, None)
+    elif self._tree.HasFile(path):
+      last_modified = self._tree.GetFileLastModified(path)
+      info = (_FILE_STAT_MODE, self._tree.GetFileSize(path),
+              time.mktime(last_modified.timetuple()))
+    elif self._tree.HasDirectory(path):
+      info = (_DIR_STAT_MODE, 0, None)
+    self._path_infos[path] = info
+    return info
 
   @staticmethod
   def _FilePathToModuleName(file_path):
@@ -696,14 +1086,7 @@ class TargetEnvironment(object):
     if self._test_portal is not None:
       module._test_portal = self._test_portal  # pylint: disable-msg=W0212
 
-    # Get and compile the source
-    source = self._tree.GetFileContents(loader.file_path)
-    assert source is not None, '{} has no source'.format(loader.file_path)
-    if self._main_method:
-      # TODO: Refactor this to use a proper getattr()
-      # call, rather than appending to user source code.
-      source += '\n' + self._main_method
-    code = compile(source, loader.file_path, 'exec')
+    code = self._GetCode(loader.file_path)
 
     # Add the module to sys.modules
     module_names = [fullname]
@@ -734,7 +1117,11 @@ class TargetEnvironment(object):
         wsgi_app = getattr(module, wsgi_app_name)
         if isinstance(wsgi_app, webapp2.WSGIApplication):
           wsgi_app = self.FixUpWebapp2WsgiApp(wsgi_app)
-        run_wsgi_app(wsgi_app)
+        if self._start_response is None:
+          run_wsgi_app(wsgi_app)
+        else:
+          # the body is iterated later, see RunScript()
+          self._wsgi_response = wsgi_app(self._environ, self._start_response)
       else:
         module_name = self._FilePathToModuleName(loader.file_path)
         handler = module_name + '.' + wsgi_app_name
@@ -744,6 +1131,40 @@ class TargetEnvironment(object):
 
     return module
 
+  def _GetCode(self, file_path):
+    """Get the compiled code of a target file.
+
+    Code is cached by the digest of the file's contents, so a file is only
+    compiled again once it changes.  Code with a main method appended is not
+    cached.
+
+    Args:
+      file_path: The path of the file in the tree.
+
+    Returns:
+      A code object.
+    """
+    key = None
+    if not self._main_method:
+      digest = self._tree.GetFileDigest(file_path)
+      if digest is not None:
+        key = _CodeCacheKey(self._namespace, file_path, digest)
+        code = _code_cache.get(key)
+        if code is not None:
+          return code
+
+    # Get and compile the source
+    source = self._tree.GetFileContents(file_path)
+    assert source is not None, '{} has no source'.format(file_path)
+    if self._main_method:
+      # TODO: Refactor this to use a proper getattr()
+      # call, rather than appending to user source code.
+      source += '\n' + self._main_method
+    code = compile(source, file_path, 'exec')
+    if key is not None:
+      _CacheCode(key, code)
+    return code
+
   def FixUpWebapp2WsgiApp(self, app):
     appengine_config = sys.modules.get('appengine_config') or {}
     webapp_add_wsgi_middleware = getattr(appengine_config,
@@ -781,20 +1202,21 @@ class TargetEnvironment(object):
   @patch.NeedsOriginal
   def _Access(self, original, path, mode):
     """Replacement for os.access."""
-    if self._IsStaticFile(path) or self._IsSkippedFile(path):
+    if self._ClassifyPath(path) != _PATH_OK:
       # static files and skipped files are inaccessible to script code
       return False
 
     in_target, path = _ResolvePath(path)
     if in_target:
-      if self._tree.HasFile(path):
+      info = self._GetPathInfo(path)
+      if info is None:
+        return False
+      elif info[0] == _FILE_STAT_MODE:
         # modes W_OK and X_OK are never allowed
         return mode & (os.X_OK | os.W_OK) == 0
-      elif self._tree.HasDirectory(path):
+      else:
         # mode W_OK is not allowed
         return mode & os.W_OK == 0
-      else:
-        return False
     else:
       return original(path, mode)
 
@@ -822,6 +1244,73 @@ class TargetEnvironment(object):
       entries = [unicode(e) for e in entries]
     return entries
 
+  @patch.NeedsOriginal
+  def _Walk(self, original, top, topdown=True, onerror=None,
+            followlinks=False):
+    """Replacement for os.walk.
+
+    The original calls os.listdir() for every directory and os.path.isdir()
+    for every entry, each of which is a separate tree query.  The tree can
+    list all of its files at once instead.
+    """
+    in_target, path = _ResolvePath(top)
+    if not in_target:
+      return original(top, topdown, onerror, followlinks)
+    info = self._GetPathInfo(path)
+    if info is None or info[0] != _DIR_STAT_MODE:
+      if onerror is not None:
+        onerror(OSError(errno.ENOENT, os.strerror(errno.ENOENT), top))
+      return iter([])
+    directories = self._ListTree(path)
+    return self._WalkTree(directories, path, top, topdown)
+
+  def _ListTree(self, path):
+    """List a directory of the tree and all its sub directories.
+
+    Args:
+      path: A directory path resolved by _ResolvePath().
+
+    Returns:
+      A dict mapping the path and every directory below it to a (directory
+      names, file names) tuple of sorted lists.
+    """
+    directories = {path: ([], [])}
+
+    def GetEntries(directory):
+      entries = directories.get(directory)
+      if entries is None:
+        entries = directories[directory] = ([], [])
+        parent, name = os.path.split(directory)
+        GetEntries(parent)[0].append(name)
+        # remember the directory for os.path.isdir() and friends
+        self._path_infos[directory] = (_DIR_STAT_MODE, 0, None)
+      return entries
+
+    prefix = path + '/' if path else ''
+    for file_path in self._tree.ListDirectory(None):
+      if file_path.startswith(prefix):
+        directory, name = os.path.split(file_path)
+        GetEntries(directory)[1].append(name)
+    for dirnames, filenames in directories.itervalues():
+      dirnames.sort()
+      filenames.sort()
+    return directories
+
+  def _WalkTree(self, directories, path, top, topdown):
+    """Yield os.walk() results from the listing made by _ListTree()."""
+    dirnames, filenames = directories[path]
+    if topdown:
+      yield top, dirnames, filenames
+    # like os.walk, honor changes made to dirnames by the caller
+    for name in dirnames:
+      sub_path = path + '/' + name if path else name
+      if sub_path in directories:
+        for result in self._WalkTree(directories, sub_path,
+                                     os.path.join(top, name), topdown):
+          yield result
+    if not topdown:
+      yield top, dirnames, filenames
+
   @patch.NeedsOriginal
   def _Rename(self, original, src, dst):
     in_target, src = _ResolvePath(src)
@@ -857,15 +1346,10 @@ class TargetEnvironment(object):
       elif self._IsSkippedFile(path):
         # Similar to _IsStaticFile above, use the original path
         raise OSError(errno.ENOENT, _ACCESSING_SKIPPED_FILE_ERROR_MSG % path)
-      elif self._tree.HasFile(resolved_path):
-        last_modified = self._tree.GetFileLastModified(resolved_path)
-        return _MakeStatResult(_FILE_STAT_MODE,
-                               self._tree.GetFileSize(resolved_path),
-                               time.mktime(last_modified.timetuple()))
-      elif self._tree.HasDirectory(resolved_path):
-        return _MakeStatResult(_DIR_STAT_MODE)
-      else:
+      info = self._GetPathInfo(resolved_path)
+      if info is None:
         raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), resolved_path)
+      return _MakeStatResult(*info)
     else:
       # if the path is not in the target file system, defer to the original
       # os.stat (usually for absolute paths like python library files, or
@@ -878,7 +1362,8 @@ class TargetEnvironment(object):
   def _IsDir(self, original, path):
     in_target, path = _ResolvePath(path)
     if in_target:
-      return self._tree.HasDirectory(path)
+      info = self._GetPathInfo(path)
+      return info is not None and info[0] == _DIR_STAT_MODE
     else:
       return original(path)
 
@@ -888,7 +1373,8 @@ class TargetEnvironment(object):
     if not path:
       return False
     if in_target:
-      return self._tree.HasFile(path)
+      info = self._GetPathInfo(path)
+      return info is not None and info[0] == _FILE_STAT_MODE
     else:
       return original(path)
 
@@ -900,13 +1386,21 @@ class TargetEnvironment(object):
     else:
       return original(path)
 
-  def RunScript(self, handler, logging_handler, main_method=''):
+  def RunScript(self, handler, logging_handler, main_method='', environ=None,
+                start_response=None):
     """Run the specified handler in the target environment.
 
     The target environment will be installed prior to and removed after
     script execution.  The script itself will appear to be the __main__
     module while it is executed.
 
+    By default a "native" WSGI application is run with run_wsgi_app() and
+    prints its response in CGI format.  If start_response is given, the
+    application is instead called directly and its body is returned without
+    being buffered.  In that case the target environment remains installed
+    until the returned body has been consumed or closed, since producing it
+    may run more target code.
+
     Args:
       handler: A str specifying the path to a python file in the tree or WSGI
           application
@@ -915,12 +1409,24 @@ class TargetEnvironment(object):
       main_method: python code to be appended to the file source and executed.
           This can be used to automatically run a function within the compiled
           source.
+      environ: The WSGI environ passed to a "native" WSGI application, required
+          with start_response.
+      start_response: The WSGI start_response callable passed to a "native"
+          WSGI application, or None to print its response.
 
     Raises:
       ScriptNotFoundError: if the specified path does not refer to a known
           file (either in the external or target file systems).
+
+    Returns:
+      An iterable of strings with the body of the WSGI application's response,
+      or None if the response was printed.
     """
     self._SetUp()
+    self._environ = environ
+    self._start_response = start_response
+    self._wsgi_response = None
+    body = None
     try:
       sys.modules.pop('__main__', None)  # force a reload of __main__
       # prevent mimic's main.py from masking the user's main.py in the case
@@ -966,22 +1472,84 @@ class TargetEnvironment(object):
       is_pkg = file_path.endswith('/__init__.py')
       loader = _Loader(self, _TARGET_ROOT, file_path, is_pkg)
       loader.load_module('__main__')
+      if self._wsgi_response is not None:
+        body = _ResponseBody(self, self._wsgi_response,
+                             namespace_manager.get_namespace(),
+                             logging_handler, saved_level)
+        return body
     except ScriptNotFoundError:
       raise
     except:
-      # Materialize the traceback here, before _TearDown() is called by our
-      # finally block, because here the 'open' builtin is still patched,
-      # giving the formatter the ability incorporate target environment user
-      # source code into the output. Without this, the offending lines of user
-      # source code would not appear in the traceback or, more confusingly,
-      # would be substitued by mimic's overlapping module source.
-      exc_info = sys.exc_info()
-      # Note format_exception relies on 'linecache', which must be reset during
-      # _TearDown(), in order to prevent caching of stale user source.
-      formatted_exception = traceback.format_exception(exc_info[0], exc_info[1],
-                                                       exc_info[2])
-      raise TargetAppError(formatted_exception)
+      raise self._MakeTargetAppError()
     finally:
-      self._TearDown()
-      logger.setLevel(saved_level)
-      logger.removeHandler(logging_handler)
+      self._environ = None
+      self._start_response = None
+      self._wsgi_response = None
+      if body is None:
+        self._Finish(logging_handler, saved_level)
+
+  def _MakeTargetAppError(self):
+    """Make a TargetAppError for the exception currently being handled."""
+    # Materialize the traceback here, before _TearDown() is called, because
+    # here the 'open' builtin is still patched, giving the formatter the
+    # ability incorporate target environment user source code into the
+    # output. Without this, the offending lines of user source code would not
+    # appear in the traceback or, more confusingly, would be substitued by
+    # mimic's overlapping module source.
+    exc_info = sys.exc_info()
+    # Note format_exception relies on 'linecache', which must be reset during
+    # _TearDown(), in order to prevent caching of stale user source.
+    formatted_exception = traceback.format_exception(exc_info[0], exc_info[1],
+                                                     exc_info[2])
+    return TargetAppError(formatted_exception)
+
+  def _Finish(self, logging_handler, saved_level):
+    """Remove the target environment and logging set up by RunScript()."""
+    self._TearDown()
+    logger = logging.getLogger()
+    logger.setLevel(saved_level)
+    logger.removeHandler(logging_handler)
+    logging.debug('Import finder: %d lookups cached, %d probed the tree',
+                  self.find_module_hits, self.find_module_misses)
+    logging.debug('Path info: %d lookups cached, %d probed the tree',
+                  self.path_info_hits, self.path_info_misses)
+    logging.debug('Restored %d baseline modules in %.6f s',
+                  self.baseline_size, self.restore_seconds)
+
+
+def GetTargetEnvironment(tree, config, namespace):
+  """Get a TargetEnvironment in which to run a request's script.
+
+  If common.config.WARM_TARGET_ENVIRONMENTS is not 0, the environments of that
+  many recently served namespaces are kept, along with the target modules they
+  loaded.  A kept environment is reused, sparing the cost of importing those
+  modules again, for as long as the version of its tree does not change.
+
+  Args:
+    tree: A mimic.common.Tree object.
+    config: The app's config loaded from the app's app.yaml, or a
+        target_info.AppConfig.
+    namespace: The datastore and memcache namespace used for metadata.
+
+  Returns:
+    A TargetEnvironment.
+  """
+  max_environments = common.config.WARM_TARGET_ENVIRONMENTS
+  version = tree.GetVersion()
+  if not max_environments or version is None:
+    return TargetEnvironment(tree, config, namespace)
+  env = _warm_environments.pop(namespace, None)
+  # pylint: disable-msg=W0212
+  if env is not None and env._tree_version != version:
+    env.Discard()
+    env = None
+  if env is None:
+    env = TargetEnvironment(tree, config, namespace, keep_modules=True)
+    env._tree_version = version
+  else:
+    # the tree is unchanged, but the tree object belongs to this request
+    env._tree = tree
+  _warm_environments[namespace] = env
+  while len(_warm_environments) > max_environments:
+    _warm_environments.popitem(last=False)[1].Discard()
+  return env
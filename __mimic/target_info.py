@@ -16,6 +16,7 @@
 
 
 
+import collections
 import re
 import sys
 
@@ -90,6 +91,12 @@ _SUPPORTED_LIBRARY_VERSIONS = dict([
 _DELTA_REGEX = r'([0-9]+)([DdHhMm]|[sS]?)'
 _EXPIRATION_REGEX = r'^\s*(%s)(\s+%s)*\s*$' % (_DELTA_REGEX, _DELTA_REGEX)
 
+# Characters which end the literal prefix of a url regular expression
+_URL_SPECIAL_CHARS = frozenset('.^$*+?{}[]\\|()')
+
+# Maximum number of path to Page results remembered by an AppConfig
+_MAX_CACHED_PAGES = 1000
+
 # Match devappserver behavior of no caching, rather than production default
 # https://developers.google.com/appengine/docs/python/config/appconfig#Static_Cache_Expiration
 _DEFAULT_STATIC_FILE_EXPIRATION = '0s'
@@ -470,20 +477,33 @@ def _ValidateConfig(config):
   checker.NoUnchecked()
 
 
-def _MatchScript(handler, path):
+def _CompileUrl(handler):
+  """Compile the url regular expression of a handler.
+
+  Args:
+    handler: A validated static_files or script handler dictionary.
+
+  Returns:
+    A compiled regular expression.
+  """
+  pattern = handler['url']
+  if not pattern.endswith('$'):
+    pattern += '$'
+  return re.compile(pattern)
+
+
+def _MatchScript(handler, regex, path):
   """Match a path to a regular expression and return a ScriptPage.
 
   Args:
     handler: A handler dictionary with a script field.
+    regex: The handler's compiled url, see _CompileUrl().
     path: The path portion of the url.
 
   Returns:
     A ScriptPage object or None.
   """
-  pattern = handler['url']
-  if not pattern.endswith('$'):
-    pattern += '$'
-  match = re.match(pattern, path)
+  match = regex.match(path)
   if match:
     template = handler['script']
     return ScriptPage(match.expand(template),
@@ -518,20 +538,18 @@ def _MatchStaticDir(handler, path):
                     expiration=handler.get('expiration'))
 
 
-def _MatchStaticFile(handler, path):
+def _MatchStaticFile(handler, regex, path):
   """Match a path to a regular expression and return a StaticPage.
 
   Args:
     handler: A handler dictionary with a static_files field.
+    regex: The handler's compiled url, see _CompileUrl().
     path: The path portion of the url.
 
   Returns:
     A StaticPage object or None.
   """
-  pattern = handler['url']
-  if not pattern.endswith('$'):
-    pattern += '$'
-  match = re.match(pattern, path)
+  match = regex.match(path)
   if not match:
     return None
   template = handler['static_files']
@@ -542,11 +560,12 @@ def _MatchStaticFile(handler, path):
                     expiration=handler.get('expiration'))
 
 
-def _MatchHandler(handler, path):
+def _MatchHandler(handler, regex, path):
   """Match a path to a handler.
 
   Args:
     handler: A handler dictionary.
+    regex: The handler's compiled url, see _CompileUrl().
     path: The path portion of the url.
 
   Returns:
@@ -555,14 +574,155 @@ def _MatchHandler(handler, path):
   if 'static_dir' in handler:
     return _MatchStaticDir(handler, path)
   elif 'static_files' in handler:
-    return _MatchStaticFile(handler, path)
+    return _MatchStaticFile(handler, regex, path)
   elif 'script' in handler:
-    return _MatchScript(handler, path)
+    return _MatchScript(handler, regex, path)
   else:
     # this should never happen on validated handlers
     assert False
 
 
+def _LiteralPrefix(pattern):
+  """Return a literal string that every match of a url pattern starts with.
+
+  Args:
+    pattern: A url regular expression, as used with re.match().
+
+  Returns:
+    A str, which may be empty.
+  """
+  if '|' in pattern or '(?' in pattern:
+    # an alternation or inline flags (e.g. case insensitivity) could let the
+    # pattern match paths without the prefix
+    return ''
+  end = 0
+  while end < len(pattern) and pattern[end] not in _URL_SPECIAL_CHARS:
+    end += 1
+  if end < len(pattern) and pattern[end] in '*?{':
+    # the last literal character is optional or repeated
+    end -= 1
+  return pattern[:max(end, 0)]
+
+
+class _Router(object):
+  """An immutable routing table compiled from validated handlers.
+
+  static_dir handlers are looked up by prefix, by trying each directory prefix
+  of the path in a dict.  This yields the first static_dir handler that
+  matches, so only the regular expression handlers before it need to be
+  tried, in order.  Those are skipped without running the regular expression
+  when the path lacks their literal prefix.
+  """
+
+  def __init__(self, handlers):
+    """Initialize from a list of validated handlers.
+
+    Args:
+      handlers: A list of handler dictionaries with explicit expirations.
+
+    Raises:
+      ValidationError: If a handler url does not compile.
+    """
+    static_dirs = {}
+    regex_handlers = []
+    for index, handler in enumerate(handlers):
+      if 'static_dir' in handler:
+        prefix = handler['url']
+        if not prefix.endswith('/'):
+          prefix += '/'
+        static_dirs.setdefault(prefix, index)
+        continue
+      try:
+        regex = _CompileUrl(handler)
+      except re.error, e:
+        raise ValidationError('url {0!r} in app.yaml handler does not '
+                              'compile: {1}'.format(handler['url'], e))
+      regex_handlers.append((index, handler, regex,
+                             _LiteralPrefix(handler['url'])))
+    self._handlers = tuple(handlers)
+    self._static_dirs = static_dirs
+    self._regex_handlers = tuple(regex_handlers)
+
+  def FindPage(self, path):
+    """Return the Page of the first handler matching path, or None."""
+    # find the first static_dir handler which matches
+    static_dir_index = len(self._handlers)
+    end = path.find('/')
+    while end != -1:
+      index = self._static_dirs.get(path[:end + 1])
+      if index is not None and index < static_dir_index:
+        static_dir_index = index
+      end = path.find('/', end + 1)
+    # earlier handlers take precedence
+    for index, handler, regex, prefix in self._regex_handlers:
+      if index > static_dir_index:
+        break
+      if path.startswith(prefix):
+        page = _MatchHandler(handler, regex, path)
+        if page is not None:
+          return page
+    if static_dir_index < len(self._handlers):
+      return _MatchStaticDir(self._handlers[static_dir_index], path)
+    return None
+
+
+class AppConfig(object):
+  """An application config which has been validated and prepared for routing.
+
+  Building an AppConfig is relatively expensive, so it is meant to be reused
+  for as long as app.yaml does not change (see mimic._GetAppConfig).
+
+  Attributes:
+    config: The app config loaded from app.yaml, in which every handler has an
+        explicit expiration.
+    file_patterns: The compiled static file and skip_files patterns, for use
+        by target_env.TargetEnvironment, or None if not created yet.
+  """
+
+  def __init__(self, config):
+    """Initialize from an app config.
+
+    Args:
+      config: The app config loaded from app.yaml.  It is modified in place.
+
+    Raises:
+      ValidationError: if the app_yaml data is invalid.
+    """
+    _ValidateConfig(config)
+    default_expiration = config.get('default_expiration',
+                                    _DEFAULT_STATIC_FILE_EXPIRATION)
+    for handler in config['handlers']:
+      # ensure handler has an explicit expiration
+      handler.setdefault('expiration', default_expiration)
+    self._router = _Router(config['handlers'])
+    # least recently used path first
+    self._pages = collections.OrderedDict()
+    self.config = config
+    self.file_patterns = None
+
+  def FindPage(self, path):
+    """Return the Page resulting from matching path against the config.
+
+    Pages are remembered for recently requested paths, so the returned Page
+    is shared and must not be modified.
+
+    Args:
+      path: The path portion of the requested URL.
+
+    Returns:
+      A Page object representing the first matching handler, or None
+      if no match is found.
+    """
+    if path in self._pages:
+      page = self._pages.pop(path)
+    else:
+      page = self._router.FindPage(path)
+      if len(self._pages) >= _MAX_CACHED_PAGES:
+        self._pages.popitem(last=False)
+    self._pages[path] = page
+    return page
+
+
 def FindPage(config, path):
   """Return the Page resulting from matching path against a config.
 
@@ -577,13 +737,4 @@ def FindPage(config, path):
   Raises:
     ValidationError: if the app_yaml data is invalid.
   """
-  _ValidateConfig(config)
-  default_expiration = config.get('default_expiration',
-                                  _DEFAULT_STATIC_FILE_EXPIRATION)
-  for handler in config['handlers']:
-    # ensure handler has an explicit expiration
-    handler.setdefault('expiration', default_expiration)
-    page = _MatchHandler(handler, path)
-    if page is not None:
-      return page
-  return None
+  return AppConfig(config).FindPage(path)
@@ -42,28 +42,42 @@ class Mimic(object):
   def __iter__(self):
     saved_in = sys.stdin
     sys.stdin = self.environ['wsgi.input']
+    # only CGI target scripts still print their response, see RunMimic()
     output = cStringIO.StringIO()
     saved_out = sys.stdout
     sys.stdout = output
     try:
       access_key = self.environ.get('mimic.access_key')
-      mimic.RunMimic(create_tree_func=common.config.CREATE_TREE_FUNC,
-                     access_key=access_key)
+      body = mimic.RunMimic(create_tree_func=common.config.CREATE_TREE_FUNC,
+                            access_key=access_key, environ=self.environ,
+                            start_response=self.start_response)
     except Exception:
       yield self._ExceptionResponse()
       return
     finally:
       sys.stdin = saved_in
       sys.stdout = saved_out
-    response = output.getvalue()
-    yield self._NormalResponse(response)
+    if body is None:
+      yield self._NormalResponse(output.getvalue())
+      return
+    try:
+      for data in body:
+        yield data
+    except Exception:
+      # start_response re-raises if the headers have already been sent
+      yield self._ExceptionResponse()
+    finally:
+      # target WSGI bodies keep the target environment installed until closed
+      if hasattr(body, 'close'):
+        body.close()
 
   def _ExceptionResponse(self):
     """Generate an error response."""
 
     status = '500 Server Error'
     response_headers = [('Content-type', 'text/html; charset=utf-8')]
-    self.start_response(status, response_headers)
+    # mimic may have already started a response, which is replaced
+    self.start_response(status, response_headers, sys.exc_info())
     return target_errors.ExcInfoAsHtml()
 
   def _NormalResponse(self, response):
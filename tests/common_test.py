@@ -15,6 +15,7 @@
 """Unit tests for common.py."""
 
 
+import datetime
 import unittest
 
 from __mimic import common
@@ -74,5 +75,56 @@ class PersistTest(unittest.TestCase):
     self.assertFalse(common.ShouldUseOriginalMemcache())
 
 
+class AcceptsGzipTest(unittest.TestCase):
+  """Unit tests for AcceptsGzip."""
+
+  def testAcceptsGzip(self):
+    self.assertTrue(common.AcceptsGzip('gzip'))
+    self.assertTrue(common.AcceptsGzip('deflate, GZIP;q=0.5'))
+    self.assertTrue(common.AcceptsGzip('x-gzip'))
+    self.assertFalse(common.AcceptsGzip(None))
+    self.assertFalse(common.AcceptsGzip('deflate'))
+    self.assertFalse(common.AcceptsGzip('gzip;q=0'))
+    self.assertFalse(common.AcceptsGzip('gzip;q=x'))
+
+
+class ConditionalRequestTest(unittest.TestCase):
+  """Unit tests for ETag, If-Modified-Since and Range helpers."""
+
+  def testFindETag(self):
+    etags = common.MakeETags('abc')
+    self.assertEquals(('"abc"', '"abc-gzip"'), etags)
+    self.assertEquals('"abc"', common.FindETag('"x", W/"abc"', etags))
+    self.assertEquals('"abc-gzip"', common.FindETag('"abc-gzip"', etags))
+    self.assertEquals('"abc"', common.FindETag('*', etags))
+    self.assertIsNone(common.FindETag('"x"', etags))
+    self.assertIsNone(common.FindETag(None, etags))
+
+  def testIsModifiedSince(self):
+    last_modified = datetime.datetime(2013, 1, 2, 3, 4, 5, 600)
+    self.assertFalse(common.IsModifiedSince('Wed, 02 Jan 2013 03:04:05 GMT',
+                                            last_modified))
+    self.assertTrue(common.IsModifiedSince('Wed, 02 Jan 2013 03:04:04 GMT',
+                                           last_modified))
+    self.assertTrue(common.IsModifiedSince('yesterday', last_modified))
+    self.assertTrue(common.IsModifiedSince(None, last_modified))
+
+  def testParseRange(self):
+    self.assertEquals((0, 10), common.ParseRange('bytes=0-9', 10))
+    self.assertEquals((5, 10), common.ParseRange('bytes=5-', 10))
+    self.assertEquals((5, 10), common.ParseRange('bytes=5-100', 10))
+    self.assertEquals((7, 10), common.ParseRange('bytes=-3', 10))
+    self.assertEquals((0, 10), common.ParseRange('bytes=-30', 10))
+    self.assertIsNone(common.ParseRange(None, 10))
+    self.assertIsNone(common.ParseRange('bytes=0-1,3-4', 10))
+    self.assertIsNone(common.ParseRange('bytes=4-3', 10))
+    self.assertIsNone(common.ParseRange('items=0-1', 10))
+    self.assertIsNone(common.ParseRange('bytes=a-b', 10))
+    self.assertRaises(common.RangeNotSatisfiableError,
+                      common.ParseRange, 'bytes=10-', 10)
+    self.assertRaises(common.RangeNotSatisfiableError,
+                      common.ParseRange, 'bytes=-1', 0)
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -16,11 +16,13 @@
 
 import cStringIO
 import datetime
+import hashlib
 import httplib
 import json
 import logging
 import time
 import unittest
+import zlib
 
 
 # Import test_util first, to ensure python27 / webapp2 are setup correctly
@@ -151,9 +153,64 @@ class ControlAppTest(unittest.TestCase):
         'Last-Modified': time_created,
         'Cache-Control': 'no-cache',
         'X-Content-Type-Options': 'nosniff',
+        'ETag': '"{0}"'.format(hashlib.sha1('123').hexdigest()),
+        'Accept-Ranges': 'bytes',
     }
     self.Check(httplib.OK, headers=headers, output='123')
 
+  def testGetFileContentsGzip(self):
+    file_contents = 'hello world ' * 1000
+    self._tree.SetFile('foo.html', file_contents)
+    self.RunWSGI('/_ah/mimic/file?path=foo.html',
+                 headers={'Accept-Encoding': 'gzip'})
+    self.Check(httplib.OK)
+    self.assertEquals('gzip', self._headers['Content-Encoding'])
+    self.assertEquals(file_contents,
+                      zlib.decompress(self._output, 16 + zlib.MAX_WBITS))
+    self.RunWSGI('/_ah/mimic/file?path=foo.html')
+    self.Check(httplib.OK, output=file_contents)
+    self.assertNotIn('Content-Encoding', self._headers)
+
+  def testGetFileNotModified(self):
+    self._tree.SetFile('foo.html', '123')
+    etag = '"{0}"'.format(hashlib.sha1('123').hexdigest())
+    self.RunWSGI('/_ah/mimic/file?path=foo.html',
+                 headers={'If-None-Match': 'W/"abc", ' + etag})
+    self.Check(httplib.NOT_MODIFIED, output='')
+    self.assertEquals(etag, self._headers['ETag'])
+    last_modified = self._tree.GetFileLastModified('foo.html')
+    self.RunWSGI('/_ah/mimic/file?path=foo.html', headers={
+        'If-Modified-Since': last_modified.strftime(
+            common.RFC_1123_DATE_FORMAT)})
+    self.Check(httplib.NOT_MODIFIED, output='')
+    # a mismatched ETag takes precedence over the date
+    self.RunWSGI('/_ah/mimic/file?path=foo.html', headers={
+        'If-None-Match': '"abc"',
+        'If-Modified-Since': last_modified.strftime(
+            common.RFC_1123_DATE_FORMAT)})
+    self.Check(httplib.OK, output='123')
+    self.RunWSGI('/_ah/mimic/file?path=foo.html', headers={
+        'If-Modified-Since': 'Sat, 01 Jan 2000 00:00:00 GMT'})
+    self.Check(httplib.OK, output='123')
+
+  def testGetFileRange(self):
+    self._tree.SetFile('foo.html', '0123456789')
+    self.RunWSGI('/_ah/mimic/file?path=foo.html',
+                 headers={'Range': 'bytes=2-4'})
+    self.Check(httplib.PARTIAL_CONTENT, output='234')
+    self.assertEquals('bytes 2-4/10', self._headers['Content-Range'])
+    self.RunWSGI('/_ah/mimic/file?path=foo.html',
+                 headers={'Range': 'bytes=-3'})
+    self.Check(httplib.PARTIAL_CONTENT, output='789')
+    self.RunWSGI('/_ah/mimic/file?path=foo.html',
+                 headers={'Range': 'bytes=20-'})
+    self.Check(httplib.REQUESTED_RANGE_NOT_SATISFIABLE)
+    self.assertEquals('bytes */10', self._headers['Content-Range'])
+    # a stale If-Range gets the whole file
+    self.RunWSGI('/_ah/mimic/file?path=foo.html',
+                 headers={'Range': 'bytes=2-4', 'If-Range': '"abc"'})
+    self.Check(httplib.OK, output='0123456789')
+
   def testGetFileContentsAllowedHost(self):
     self._tree.SetFile('foo.html', '123')
     now = datetime.datetime.utcnow()
@@ -166,6 +223,8 @@ class ControlAppTest(unittest.TestCase):
         'Last-Modified': time_created,
         'Cache-Control': 'no-cache',
         'X-Content-Type-Options': 'nosniff',
+        'ETag': '"{0}"'.format(hashlib.sha1('123').hexdigest()),
+        'Accept-Ranges': 'bytes',
     }
     self.Check(httplib.OK, headers=headers)
 
@@ -191,6 +250,8 @@ class ControlAppTest(unittest.TestCase):
         'Cache-Control': 'no-cache',
         'Last-Modified': time_created,
         'X-Content-Type-Options': 'nosniff',
+        'ETag': '"{0}"'.format(hashlib.sha1('pretty').hexdigest()),
+        'Accept-Ranges': 'bytes',
     }
     self.Check(httplib.OK, headers=headers, output='pretty')
 
@@ -338,7 +399,7 @@ class ControlAppTest(unittest.TestCase):
 
   def testMoveFile(self):
     class MutableTree(object):
-      def MoveFile(self, path, newpath):
+      def MovePath(self, path, newpath):
         self.path = path
         self.newpath = newpath
 
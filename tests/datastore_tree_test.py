@@ -15,14 +15,21 @@
 """Unit tests for datastore_tree."""
 
 
+import cStringIO
 import datetime
+import gzip
+import hashlib
 import os
 import unittest
+import zlib
 
 from __mimic import common
 from __mimic import datastore_tree
 from tests import test_util
 
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
 
 class DatastoreTreeTest(unittest.TestCase):
   """Unit tests for DatastoreTree."""
@@ -71,6 +78,33 @@ class DatastoreTreeTest(unittest.TestCase):
     self.assertIsNone(self._tree.GetFileContents('/foo'))
     self.assertEquals('123', self._tree.GetFileContents('/foo/fooz'))
 
+  def testMoveDirectory(self):
+    self._tree.SetFile('/boo/bat', '456')
+    self._tree.SetFile('/boo/sub/bot', '789')
+    self._tree.SetFile('/baz/bat', 'old')
+    self.assertTrue(self._tree.MovePath('/boo', '/baz'))
+    self.assertFalse(self._tree.HasDirectory('/boo'))
+    self.assertEquals(['bat', 'sub'], self._tree.ListDirectory('/baz'))
+    self.assertEquals('456', self._tree.GetFileContents('/baz/bat'))
+    self.assertEquals('789', self._tree.GetFileContents('/baz/sub/bot'))
+    self.assertEquals(['/bar', '/baz/bat', '/baz/sub/bot', '/foo'],
+                      self._tree.ListDirectory(None))
+    # a single file can be moved too
+    self.assertTrue(self._tree.MovePath('/baz/bat', '/bat'))
+    self.assertEquals('456', self._tree.GetFileContents('/bat'))
+    # moving into itself, or a missing path, does nothing
+    self.assertFalse(self._tree.MovePath('/baz', '/baz/sub'))
+    self.assertFalse(self._tree.MovePath('/boo', '/moo'))
+    self.assertEquals('789', self._tree.GetFileContents('/baz/sub/bot'))
+
+  def testMoveDirectoryToParent(self):
+    self._tree.SetFile('/a/b/x', 'x')
+    self._tree.SetFile('/a/b/b/y', 'y')
+    self.assertTrue(self._tree.MovePath('/a/b', '/a'))
+    self.assertEquals(['/a/b/y', '/a/x', '/bar', '/foo'],
+                      self._tree.ListDirectory(None))
+    self.assertEquals('y', self._tree.GetFileContents('/a/b/y'))
+
   def testDeleteFile(self):
     self.assertTrue(self._tree.HasFile('/foo'))
     self.assertEquals('123', self._tree.GetFileContents('/foo'))
@@ -117,6 +151,196 @@ class DatastoreTreeTest(unittest.TestCase):
     self._tree.Clear()
     self.assertEquals(set(), set(self._tree.ListDirectory('/')))
 
+  def testPutFilesInBatches(self):
+    count = datastore_tree.MAX_FILES_PER_TRANSACTION + 1
+    paths = sorted('d/%03d.py' % i for i in range(count))
+    self._tree.PutFiles([(path, path, None) for path in paths])
+    self.assertEquals([path[2:] for path in paths],
+                      self._tree.ListDirectory('d'))
+    self.assertEquals(paths, self._tree.ListDirectory(None))
+    self.assertEquals(paths[-1], self._tree.GetFileContents(paths[-1]))
+
+  def testListDirectoryIndex(self):
+    self._tree.SetFile('a/b/c.py', '')
+    self._tree.SetFile('a/d.py', '')
+    self._tree.PutFiles([('a/b/e.py', '', None), ('f.py', '', None)])
+    self.assertEquals(['', 'a', 'f.py'], self._tree.ListDirectory(''))
+    self.assertEquals(['b', 'd.py'], self._tree.ListDirectory('a'))
+    self.assertEquals(['c.py', 'e.py'], self._tree.ListDirectory('a/b/'))
+    self.assertEquals([], self._tree.ListDirectory('a/d.py'))
+    self._tree.MoveFile('a/b/c.py', 'g/c.py')
+    self.assertEquals(['e.py'], self._tree.ListDirectory('a/b'))
+    self.assertEquals(['c.py'], self._tree.ListDirectory('g'))
+    # removing the last file of a directory removes the directory
+    self._tree.DeletePath('a/b/e.py')
+    self.assertFalse(self._tree.HasDirectory('a/b'))
+    self.assertEquals(['d.py'], self._tree.ListDirectory('a'))
+    self._tree.DeletePath('a')
+    self.assertFalse(self._tree.HasDirectory('a'))
+    self.assertEquals(['', 'f.py', 'g'], self._tree.ListDirectory(''))
+
+  def testDirectoryIndexEntries(self):
+    self._tree.PutFiles([('d/%d.py' % i, '', None) for i in range(3)])
+    self._tree.SetFile('d/e/f.py', '')
+    # every entry of a directory is a separate entity
+    query = datastore_tree._AhMimicDirectoryEntry.query(
+        ancestor=self._tree._DirectoryKey('d/'))
+    self.assertEquals(['0.py', '1.py', '2.py', 'e/'],
+                      [key.id() for key in query.fetch(keys_only=True)])
+    # swapping two files keeps both of them
+    self._tree._MoveFiles({'d/0.py': 'd/1.py', 'd/1.py': 'd/0.py'})
+    self.assertEquals(['0.py', '1.py', '2.py', 'e'],
+                      self._tree.ListDirectory('d'))
+    self._tree.DeletePath('d/e/f.py')
+    self.assertEquals(['0.py', '1.py', '2.py'], self._tree.ListDirectory('d'))
+    self.assertEquals([], datastore_tree._AhMimicDirectoryEntry.query(
+        ancestor=self._tree._DirectoryKey('d/e/')).fetch(keys_only=True))
+
+  def testListDirectoryRebuildsMissingIndex(self):
+    self._tree.SetFile('a/b.py', '')
+    ndb.delete_multi(datastore_tree._AhMimicDirectoryEntry.query(
+        ancestor=self._tree.root).fetch(keys_only=True))
+    tree = datastore_tree.DatastoreTree()
+    self.assertTrue(tree.HasDirectory('a'))
+    self.assertEquals(['b.py'], tree.ListDirectory('a'))
+
+  def testGetFileContentsCached(self):
+    self.assertEquals('123', self._tree.GetFileContents('/foo'))
+    # change the entity behind the tree's back, the cached value is used
+    datastore_tree._AhMimicFile(id='/foo', parent=self._tree.root,
+                                contents='abc').put()
+    self.assertEquals('123', self._tree.GetFileContents('/foo'))
+    self.assertEquals('123', datastore_tree.DatastoreTree().GetFileContents(
+        '/foo'))
+    # any modification of the tree invalidates the cache
+    version = self._tree.GetVersion()
+    self._tree.SetFile('/bar', '789')
+    self.assertNotEquals(version, self._tree.GetVersion())
+    self.assertEquals('abc', self._tree.GetFileContents('/foo'))
+    self.assertEquals('789', self._tree.GetFileContents('/bar'))
+
+  def testVersionNotIncremented(self):
+    self.assertEquals('123', self._tree.GetFileContents('/foo'))
+    saved_incr = memcache.incr
+    saved_delete = memcache.delete
+    memcache.incr = lambda *args, **kwargs: None
+    try:
+      # the old version is dropped, so the cached contents are not seen
+      self._tree.SetFile('/foo', '456')
+      self.assertEquals('456', datastore_tree.DatastoreTree().GetFileContents(
+          '/foo'))
+      # when that fails too the tree stops caching
+      memcache.delete = (
+          lambda *args, **kwargs: memcache.DELETE_NETWORK_FAILURE)
+      self._tree.SetFile('/foo', '789')
+      self.assertIsNone(self._tree.GetVersion())
+      self.assertEquals('789', self._tree.GetFileContents('/foo'))
+    finally:
+      memcache.incr = saved_incr
+      memcache.delete = saved_delete
+
+  def testGetLargeFileContentsCached(self):
+    file_contents = ('abcdefghij' *
+                     (datastore_tree.MAX_BYTES_FOR_MEMCACHE_VALUE / 10 + 1))
+    self._tree.SetFile('/large_file', file_contents)
+    ndb.delete_multi(ndb.Query(ancestor=self._tree.root).fetch(keys_only=True))
+    self.assertEquals(file_contents, self._tree.GetFileContents('/large_file'))
+    memcache.flush_all()
+    self.assertIsNone(self._tree.GetFileContents('/large_file'))
+
+  def testMetadataFromManifest(self):
+    # incompressible, so the contents are stored as plain chunks
+    file_contents = os.urandom(datastore_tree.MAX_BYTES_FOR_ENTITY + 1)
+    self._tree.SetFile('/large_file', file_contents)
+    # delete the file entities, metadata is still served from the manifest
+    ndb.delete_multi(datastore_tree._AhMimicFile.query(
+        ancestor=self._tree.root).fetch(keys_only=True))
+    self.assertTrue(self._tree.HasFile('/foo'))
+    self.assertEquals(3, self._tree.GetFileSize('/foo'))
+    self.assertEquals(len(file_contents),
+                      self._tree.GetFileSize('/large_file'))
+    self.assertIsInstance(self._tree.GetFileLastModified('/large_file'),
+                          datetime.datetime)
+    self.assertEquals(['/bar', '/foo', '/large_file'],
+                      self._tree.ListDirectory(None))
+    # a new manifest is built once the tree changes
+    self._tree.DeletePath('/foo')
+    self.assertFalse(self._tree.HasFile('/foo'))
+    self.assertTrue(self._tree.HasFile('/large_file'))
+
+  def testFileMetadata(self):
+    entity = datastore_tree._AhMimicFile.get_by_id('/foo',
+                                                   parent=self._tree.root)
+    self.assertEquals(3, entity.size)
+    self.assertEquals(hashlib.sha1('123').hexdigest(), entity.digest)
+    self.assertEquals(entity.digest, self._tree.GetFileDigest('/foo'))
+    self.assertIsNone(self._tree.GetFileDigest('/fooz'))
+    self._tree.MoveFile('/foo', '/fooz')
+    self.assertEquals(entity.digest, self._tree.GetFileDigest('/fooz'))
+
+  def testBackfillMetadata(self):
+    legacy = datastore_tree._AhMimicFile(id='/foo', parent=self._tree.root,
+                                         contents='123')
+    legacy.put()
+    self.assertEquals(1, datastore_tree.BackfillMetadata())
+    entity = datastore_tree._AhMimicFile.get_by_id('/foo',
+                                                   parent=self._tree.root)
+    self.assertEquals(3, entity.size)
+    self.assertEquals(hashlib.sha1('123').hexdigest(), entity.digest)
+    self.assertEquals(legacy.updated, entity.updated)
+    self.assertEquals(0, datastore_tree.BackfillMetadata())
+
+  def _GetBlobRefCounts(self):
+    query = datastore_tree._AhMimicBlobRefCount.query(
+        namespace=common.config.NAMESPACE)
+    return dict((refs.key.parent().id(), refs.count) for refs in query)
+
+  def testContentsDeduplicated(self):
+    # incompressible, so the contents are stored as plain chunks
+    file_contents = os.urandom(datastore_tree.MAX_BYTES_FOR_ENTITY + 1)
+    other_tree = datastore_tree.DatastoreTree('other')
+    self._tree.SetFile('/a/large_file', file_contents)
+    self._tree.SetFile('/b/large_file', file_contents)
+    other_tree.SetFile('large_file', file_contents)
+    chunk_digests = [hashlib.sha1(chunk).hexdigest() for chunk in
+                     (file_contents[:datastore_tree.MAX_BYTES_FOR_ENTITY],
+                      file_contents[datastore_tree.MAX_BYTES_FOR_ENTITY:])]
+    counts = self._GetBlobRefCounts()
+    self.assertEquals([3, 3], [counts[d] for d in chunk_digests])
+    # moving a file doesn't touch its contents
+    self._tree.MoveFile('/a/large_file', '/c/large_file')
+    self.assertEquals(counts, self._GetBlobRefCounts())
+    self.assertEquals(file_contents,
+                      self._tree.GetFileContents('/c/large_file'))
+    self._tree.DeletePath('/b')
+    counts = self._GetBlobRefCounts()
+    self.assertEquals([2, 2], [counts[d] for d in chunk_digests])
+    self._tree.Clear()
+    other_tree.Clear()
+    counts = self._GetBlobRefCounts()
+    self.assertFalse(any(d in counts for d in chunk_digests))
+    self.assertIsNone(datastore_tree._AhMimicBlob.get_by_id(
+        chunk_digests[0], namespace=common.config.NAMESPACE))
+
+  def testLegacyChunkedFile(self):
+    file_key = ndb.Key(datastore_tree._AhMimicFile, '/legacy',
+                       parent=self._tree.root)
+    chunks = [datastore_tree._AhMimicChunk(
+        key=ndb.Key(datastore_tree._AhMimicChunk, i, parent=file_key),
+        contents=contents) for i, contents in ((1, 'abc'), (2, 'def'))]
+    ndb.put_multi(chunks)
+    datastore_tree._AhMimicFile(key=file_key,
+                                chunk_keys=[c.key for c in chunks]).put()
+    tree = datastore_tree.DatastoreTree()
+    self.assertEquals('abcdef', tree.GetFileContents('/legacy'))
+    tree.MoveFile('/legacy', '/moved')
+    self.assertEquals('abcdef', tree.GetFileContents('/moved'))
+    self.assertEquals(6, tree.GetFileSize('/moved'))
+    self.assertIsNone(chunks[0].key.get())
+    tree.DeletePath('/moved')
+    self.assertEquals([], datastore_tree._AhMimicChunk.query(
+        ancestor=tree.root).fetch())
+
   def testClear(self):
     self._tree.Clear()
     self.assertFalse(self._tree.HasFile('/foo'))
@@ -146,6 +370,71 @@ class DatastoreTreeTest(unittest.TestCase):
     self._tree.DeletePath('/')
     self.assertIsNone(self._tree.GetFileContents('/new_file'))
 
+  def testPutAndGetFiles(self):
+    large_contents = 'x' * (datastore_tree.MAX_BYTES_FOR_ENTITY + 1)
+    self._tree.PutFiles([('/foo', 'new', None),
+                         ('/d/large_file', large_contents, None),
+                         ('/d/small_file', 'small', None)])
+    files = sorted(self._tree.GetFiles(None))
+    self.assertEquals(['/bar', '/d/large_file', '/d/small_file', '/foo'],
+                      [f[0] for f in files])
+    self.assertEquals(['456', large_contents, 'small', 'new'],
+                      [f[1] for f in files])
+    self.assertEquals([('/d/large_file', large_contents),
+                       ('/d/small_file', 'small')],
+                      sorted((f[0], f[1]) for f in self._tree.GetFiles('/d')))
+
+  def testCompressedFile(self):
+    file_contents = 'hello world ' * 1000
+    self._tree.SetFile('/hello.txt', file_contents)
+    entity = datastore_tree._AhMimicFile.get_by_id('/hello.txt',
+                                                   parent=self._tree.root)
+    self.assertEquals(datastore_tree.ENCODING_DEFLATE, entity.encoding)
+    self.assertEquals(file_contents, entity.GetContents())
+    gzip_contents = self._tree.GetFileGzipContents('/hello.txt')
+    self.assertEquals(
+        file_contents,
+        gzip.GzipFile(fileobj=cStringIO.StringIO(gzip_contents)).read())
+    # uncompressed files aren't available as gzip
+    self.assertIsNone(self._tree.GetFileGzipContents('/foo'))
+    self.assertIsNone(self._tree.GetFileGzipContents('/fooz'))
+    self._tree.MoveFile('/hello.txt', '/bye.txt')
+    self.assertEquals(gzip_contents, self._tree.GetFileGzipContents('/bye.txt'))
+
+  def testCompressedLargeFile(self):
+    file_contents = ''.join(str(i) for i in xrange(
+        datastore_tree.MAX_BYTES_FOR_ENTITY))
+    self._tree.SetFile('/large_file', file_contents)
+    entity = datastore_tree._AhMimicFile.get_by_id('/large_file',
+                                                   parent=self._tree.root)
+    self.assertEquals(datastore_tree.ENCODING_DEFLATE, entity.encoding)
+    self.assertTrue(len(entity.chunk_keys) > 1)
+    self.assertEquals(file_contents, self._tree.GetFileContents('/large_file'))
+    self.assertEquals(file_contents, zlib.decompress(
+        self._tree.GetFileGzipContents('/large_file'), 16 + zlib.MAX_WBITS))
+
+  def testGetFileChunks(self):
+    self.assertEquals(['123'], list(self._tree.GetFileChunks('/foo')))
+    self.assertEquals(['2'], list(self._tree.GetFileChunks('/foo', 1, 2)))
+    self.assertEquals([], list(self._tree.GetFileChunks('/foo', 5)))
+    self.assertIsNone(self._tree.GetFileChunks('/fooz'))
+
+  def testGetLargeFileChunks(self):
+    size = datastore_tree.MAX_BYTES_FOR_ENTITY
+    for path, file_contents in (
+        ('/large_file', os.urandom(size * 2 + 10)),
+        ('/compressed_file', ''.join(str(i) for i in xrange(size / 2)))):
+      self._tree.SetFile(path, file_contents)
+      chunks = list(self._tree.GetFileChunks(path))
+      self.assertTrue(len(chunks) > 1)
+      self.assertEquals(file_contents, ''.join(chunks))
+      start, end = size - 5, size * 2 + 5
+      self.assertEquals(file_contents[start:end],
+                        ''.join(self._tree.GetFileChunks(path, start, end)))
+      self.assertEquals(file_contents[size + 1:size + 2],
+                        ''.join(self._tree.GetFileChunks(path, size + 1,
+                                                         size + 2)))
+
   def testBinaryLargeFile(self):
     file_contents = open(
         os.path.join(os.path.dirname(__file__), 'testfiles', 'test.jpg'),
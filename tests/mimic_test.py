@@ -16,9 +16,11 @@
 
 import cStringIO
 from email import feedparser
+import hashlib
 import httplib
 import os
 import sys
+import zlib
 
 
 
@@ -198,6 +200,7 @@ class MimicTest(unittest.TestCase):
     os.environ['PATH_INFO'] = ''
     os.environ['QUERY_STRING'] = ''
     mimic._dev_appserver_state = {}
+    mimic._app_configs.clear()
     # files that will be part of the tree
     self._files = {}
     # these are filled in from mimic's response during CallMimic()
@@ -220,7 +223,7 @@ class MimicTest(unittest.TestCase):
 
   def _CallMimic(self, path,
                  http_host='project-id.your-app-id.appspot.com',
-                 os_environ=None):
+                 os_environ=None, wsgi=False):
     # TODO: at some point we might need to expand the set of environ
     # variables set, support POST, etc.  For now this is enough to test what
     # we want.
@@ -235,6 +238,17 @@ class MimicTest(unittest.TestCase):
     saved_out = sys.stdout
     try:
       sys.stdout = output
+      if wsgi:
+        environ = dict(os.environ)
+        environ['wsgi.input'] = cStringIO.StringIO()
+        body = mimic.RunMimic(create_tree_func=self._CreateTree,
+                              access_key=None, users_mod=self._users_mod,
+                              environ=environ,
+                              start_response=self._StartResponse)
+        # nothing should be printed for natively handled responses
+        self.assertEquals('', output.getvalue())
+        self._body = ''.join(body)
+        return
       mimic.RunMimic(create_tree_func=self._CreateTree, access_key=None,
                      users_mod=self._users_mod)
     finally:
@@ -247,6 +261,11 @@ class MimicTest(unittest.TestCase):
 
     self._ParseResponse(output.getvalue())
 
+  def _StartResponse(self, status, headers):
+    """A WSGI start_response callable for _CallMimic(wsgi=True)."""
+    self._status = status
+    self._headers = dict(headers)
+
   def _AddFile(self, path, contents):
     """Add a file to the tree used by mimic."""
     self._files[path] = contents
@@ -295,6 +314,58 @@ class MimicTest(unittest.TestCase):
     self._CheckResponse(httplib.OK, 'text/plain; charset=utf-8')
     self.assertEquals('123', self._body)
 
+  def testAppConfigCached(self):
+    self._AddFile('app.yaml', MakeAppYaml())
+    self._AddFile('static/foo.txt', '123')
+    self._CallMimic('/foo.txt')
+    self.assertIsNone(self._headers.get('Cache-Control'))
+    [(_, app_config)] = mimic._app_configs.values()
+    self._CallMimic('/foo.txt')
+    self.assertIs(app_config, mimic._app_configs.values()[0][1])
+    # a changed app.yaml is parsed again
+    self._AddFile('app.yaml', MakeAppYaml(expiration='2h'))
+    self._CallMimic('/foo.txt')
+    self.assertResponseExpiration(7200)
+    self.assertIsNot(app_config, mimic._app_configs.values()[0][1])
+
+  def testAppConfigsBounded(self):
+    self._AddFile('app.yaml', MakeAppYaml())
+    for i in range(mimic._MAX_APP_CONFIGS + 1):
+      app_config, _ = mimic._GetAppConfig(
+          self._CreateTree('ns%d' % i, None), 'ns%d' % i)
+      self.assertIsNotNone(app_config)
+    self.assertEquals(mimic._MAX_APP_CONFIGS, len(mimic._app_configs))
+    # the least recently used namespace was dropped
+    self.assertFalse('ns0' in mimic._app_configs)
+    self.assertTrue('ns%d' % mimic._MAX_APP_CONFIGS in mimic._app_configs)
+
+  def testStaticPageGzip(self):
+    file_contents = 'hello world ' * 1000
+    self._AddFile('app.yaml', _GENERIC_APP_YAML)
+    self._AddFile('static/foo.txt', file_contents)
+    self._CallMimic('/foo.txt', os_environ={'HTTP_ACCEPT_ENCODING': 'gzip'})
+    self._CheckResponse(httplib.OK, 'text/plain; charset=utf-8')
+    self.assertEquals('gzip', self._headers.get('Content-Encoding'))
+    self.assertEquals(file_contents,
+                      zlib.decompress(self._body, 16 + zlib.MAX_WBITS))
+
+  def testStaticPageNotModified(self):
+    self._AddFile('app.yaml', _GENERIC_APP_YAML)
+    self._AddFile('static/foo.txt', '123')
+    etag = '"{0}"'.format(hashlib.sha1('123').hexdigest())
+    self._CallMimic('/foo.txt', os_environ={'HTTP_IF_NONE_MATCH': etag})
+    self._CheckResponse(httplib.NOT_MODIFIED, 'text/plain; charset=utf-8')
+    self.assertEquals(etag, self._headers.get('ETag'))
+    self.assertEquals('', self._body)
+
+  def testStaticPageRange(self):
+    self._AddFile('app.yaml', _GENERIC_APP_YAML)
+    self._AddFile('static/foo.txt', '0123456789')
+    self._CallMimic('/foo.txt', os_environ={'HTTP_RANGE': 'bytes=3-'})
+    self._CheckResponse(httplib.PARTIAL_CONTENT, 'text/plain; charset=utf-8')
+    self.assertEquals('bytes 3-9/10', self._headers.get('Content-Range'))
+    self.assertEquals('3456789', self._body)
+
   def testStaticPageDefaultMimeType(self):
     self._AddFile('app.yaml', _GENERIC_APP_YAML)
     self._AddFile('static/foo.unknown', r'\u3020\u3020')
@@ -652,6 +723,21 @@ class MimicTest(unittest.TestCase):
     # should be a response containing a mimic identifier and some version info
     self.assertTrue(str(common.VERSION_ID) in self._body)
 
+  def testStaticPageWsgi(self):
+    self._AddFile('app.yaml', _GENERIC_APP_YAML)
+    self._AddFile('static/foo.txt', '123')
+    self._CallMimic('/foo.txt', wsgi=True)
+    self._CheckResponse(httplib.OK, 'text/plain; charset=utf-8')
+    self.assertEquals('123', self._body)
+    self._CallMimic('/missing.txt', wsgi=True)
+    self._CheckResponse(httplib.NOT_FOUND, 'text/html; charset=utf-8')
+
+  def testVersionIdWsgi(self):
+    self._CallMimic('/_ah/mimic/version_id',
+                    http_host='your-app-id.appspot.com', wsgi=True)
+    self._CheckResponse(httplib.OK, 'text/plain; charset=utf-8')
+    self.assertTrue(str(common.VERSION_ID) in self._body)
+
   def testTreeWithoutProjectId(self):
     self._AddFile('app.yaml', _GENERIC_APP_YAML)
     self._AddFile('main.py', _SIMPLE_CGI_SCRIPT)
@@ -18,6 +18,7 @@
 import cStringIO
 import encodings
 import errno
+import imp
 import logging
 import os
 import re
@@ -29,7 +30,8 @@ import tempfile
 # Import test_util first, to ensure python27 / webapp2 are setup correctly
 from tests import test_util  # pylint: disable-msg=C6203
 
-from __mimic import datastore_tree  # pylint: disable-msg=C6203
+from __mimic import common  # pylint: disable-msg=C6203
+from __mimic import datastore_tree
 from __mimic import target_env
 from __mimic import target_info
 from tests import testpackage
@@ -127,6 +129,20 @@ APP = webapp2.WSGIApplication([
 _test_portal.APP = APP
 """
 
+_STREAMING_MAIN = r"""
+import os
+
+def _Body():
+  yield 'first,'
+  _test_portal.cwd = os.getcwd()
+  yield 'second'
+
+def APP(environ, start_response):
+  _test_portal.path_info = environ['PATH_INFO']
+  start_response('200 OK', [('Content-Type', 'text/plain')])
+  return _Body()
+"""
+
 
 class TestPortal(object):
   """A trivial class that lets target code exchange data with the test."""
@@ -175,6 +191,29 @@ class TargetEnvironmentTest(unittest.TestCase):
     self._env._TearDown()
     self.assertIsNone(target_env.TargetEnvironment.Instance())
 
+  def testSetUpFailure(self):
+
+    class FailingPatch(object):
+
+      def Install(self):
+        raise RuntimeError('install failed')
+
+    self._env._TearDown()
+    path = list(sys.path)
+    env = target_env.TargetEnvironment(self._tree, _TEST_CONFIG,
+                                       'project-name')
+    env.AddPatch(FailingPatch())
+    self.assertRaises(RuntimeError, env._SetUp)
+    self.assertIsNone(target_env.TargetEnvironment.Instance())
+    self.assertEquals(path, sys.path)
+    # the patches were removed
+    self._tree.SetFile('mimic_set_up_failure.txt', 'abc')
+    self.assertRaises(IOError, open, 'mimic_set_up_failure.txt')
+    # other environments can still be installed
+    self._env._SetUp()
+    self.assertEquals(self._env, target_env.TargetEnvironment.Instance())
+    env._patches = None
+
   def testSingleImport(self):
     self._tree.SetFile('foo.py', 'x = 123')
     import foo  # pylint: disable-msg=C6204, W0612
@@ -183,6 +222,23 @@ class TargetEnvironmentTest(unittest.TestCase):
     self.assertEquals('/target/foo.py', foo.__file__)
     self.assertEquals('foo', foo.__name__)
 
+  def testCompiledCodeCached(self):
+    target_env._code_cache.clear()
+    self._tree.SetFile('foo.py', 'x = 123')
+    import foo  # pylint: disable-msg=C6204, W0612
+    self.assertEquals(123, foo.x)
+    digest = self._tree.GetFileDigest('foo.py')
+    self.assertIn(target_env._CodeCacheKey('project-name', 'foo.py', digest),
+                  target_env._code_cache)
+    # code is never shared with other projects
+    self.assertNotIn(target_env._CodeCacheKey('other', 'foo.py', digest),
+                     target_env._code_cache)
+    # a changed file is compiled again
+    del sys.modules['foo']
+    self._tree.SetFile('foo.py', 'x = 456')
+    import foo  # pylint: disable-msg=C6204, W0612, W0404
+    self.assertEquals(456, foo.x)
+
   def testPackageImport(self):
     self._tree.SetFile('foo/__init__.py', 'x = 123')
     import foo  # pylint: disable-msg=C6204, W0612
@@ -280,6 +336,14 @@ y = 1 / 0  # will cause a ZeroDivisionError
     self.assertTrue(_test_portal.foo_in_modules)
     self.assertFalse('foo' in sys.modules)
 
+  def testErrorInMainRestoresMain(self):
+    original_main = sys.modules['__main__']
+    self._env._TearDown()  # RunScript will set up the env
+    self._tree.SetFile('foo.py', 'y = 1 / 0  # will cause a ZeroDivisionError')
+    self.assertRaises(target_env.TargetAppError, self._env.RunScript,
+                      'foo.py', CollectingHandler())
+    self.assertIs(original_main, sys.modules['__main__'])
+
   def testImportPackageInsidePackage(self):
     self._env._TearDown()  # RunScript will set up the env
     self._tree.SetFile('main.py', """
@@ -416,6 +480,44 @@ raise ImportError
     except ImportError:
       pass  # expected
 
+  def testFindModuleCached(self):
+    self.assertRaises(ImportError, __import__, 'foo')
+    self.assertEquals((0, 1), (self._env.find_module_hits,
+                               self._env.find_module_misses))
+    self.assertRaises(ImportError, __import__, 'foo')
+    self.assertEquals((1, 1), (self._env.find_module_hits,
+                               self._env.find_module_misses))
+    # a change to the tree is seen
+    self._tree.SetFile('foo.py', 'x = 123')
+    self.assertEquals(123, __import__('foo').x)
+    self.assertEquals((1, 2), (self._env.find_module_hits,
+                               self._env.find_module_misses))
+
+  def testBaselineModules(self):
+    self._tree.SetFile('foo.py', 'x = 123')
+    import foo  # pylint: disable-msg=C6204, W0612
+    self._env._TearDown()
+    baseline = target_env._baseline_modules  # pylint: disable-msg=W0212
+    self.assertEquals(sys.modules, baseline)
+    self.assertEquals(len(baseline), self._env.baseline_size)
+    # modules imported outside the environment join the baseline
+    sys.modules['mimic_baseline_test'] = None
+    try:
+      self._env._SetUp()
+      self.assertTrue('mimic_baseline_test' in baseline)
+      self._env._TearDown()
+      self.assertTrue('mimic_baseline_test' in sys.modules)
+      # as do modules replaced outside the environment
+      module = imp.new_module('mimic_baseline_test')
+      sys.modules['mimic_baseline_test'] = module
+      self._env._SetUp()
+      self._env._TearDown()
+      self.assertIs(module, sys.modules['mimic_baseline_test'])
+      self.assertIs(module, baseline['mimic_baseline_test'])
+    finally:
+      del sys.modules['mimic_baseline_test']
+    self._env._SetUp()
+
   def testRunScript(self):
     self._env._TearDown()  # RunScript will set up the env
     self._tree.SetFile('d/foo.py', _SIMPLE_D_FOO)
@@ -509,6 +611,85 @@ logging.debug('running foo.py')
                       'Content-Length: 18\n\n'
                       'main-response-body', self._output.getvalue())
 
+  def testWsgiAppStreaming(self):
+    self._env._TearDown()  # RunScript will set up the env
+    self._tree.SetFile('main.py', _STREAMING_MAIN)
+    level = logging.getLogger().level
+    responses = []
+
+    def StartResponse(status, headers):
+      responses.append((status, headers))
+
+    body = self._env.RunScript('main.APP', CollectingHandler(),
+                               environ={'PATH_INFO': '/streaming'},
+                               start_response=StartResponse)
+    self.assertEquals([('200 OK', [('Content-Type', 'text/plain')])],
+                      responses)
+    self.assertEquals('/streaming', _test_portal.path_info)
+    # the target environment stays installed while the body is produced
+    self.assertIs(self._env, target_env.TargetEnvironment.Instance())
+    self.assertEquals('first,second', ''.join(body))
+    self.assertEquals('/target', _test_portal.cwd)
+    self.assertIsNone(target_env.TargetEnvironment.Instance())
+    self.assertEquals(level, logging.getLogger().level)
+    self.assertEquals('', self._output.getvalue())
+
+  def testWsgiAppStreamingClosed(self):
+    self._env._TearDown()  # RunScript will set up the env
+    self._tree.SetFile('main.py', _STREAMING_MAIN)
+    body = self._env.RunScript('main.APP', CollectingHandler(),
+                               environ={'PATH_INFO': '/'},
+                               start_response=lambda *args: None)
+    self.assertEquals('first,', iter(body).next())
+    body.close()
+    self.assertIsNone(target_env.TargetEnvironment.Instance())
+
+  def testWsgiAppStreamingClosedBeforeIteration(self):
+    self._env._TearDown()  # RunScript will set up the env
+    self._tree.SetFile('main.py', _STREAMING_MAIN)
+    level = logging.getLogger().level
+    body = self._env.RunScript('main.APP', CollectingHandler(),
+                               environ={'PATH_INFO': '/'},
+                               start_response=lambda *args: None)
+    body.close()
+    self.assertIsNone(target_env.TargetEnvironment.Instance())
+    self.assertEquals(level, logging.getLogger().level)
+    # a dropped body removes the environment too
+    body = self._env.RunScript('main.APP', CollectingHandler(),
+                               environ={'PATH_INFO': '/'},
+                               start_response=lambda *args: None)
+    del body
+    self.assertIsNone(target_env.TargetEnvironment.Instance())
+
+  def testWarmEnvironment(self):
+    self._env._TearDown()  # RunScript will set up the env
+    self._tree.SetFile('foo.py', 'import bar\nbar.runs.append(1)\n')
+    self._tree.SetFile('bar.py', 'runs = []\n')
+    saved_warm_environments = common.config.WARM_TARGET_ENVIRONMENTS
+    common.config.WARM_TARGET_ENVIRONMENTS = 1
+    try:
+      env = target_env.GetTargetEnvironment(self._tree, _TEST_CONFIG, 'ns')
+      env.RunScript('foo.py', CollectingHandler())
+      self.assertFalse('bar' in sys.modules)
+      self.assertIs(env, target_env.GetTargetEnvironment(self._tree,
+                                                         _TEST_CONFIG, 'ns'))
+      env.RunScript('foo.py', CollectingHandler())
+      self.assertFalse('bar' in sys.modules)
+      # bar was only imported once
+      self.assertEquals([1, 1], env._warm_modules['bar'].runs)
+      # a change to the tree starts over
+      self._tree.SetFile('baz.py', '')
+      new_env = target_env.GetTargetEnvironment(self._tree, _TEST_CONFIG, 'ns')
+      self.assertIsNot(env, new_env)
+      self.assertEquals({}, env._warm_modules)
+      new_env.RunScript('foo.py', CollectingHandler())
+      self.assertEquals([1], new_env._warm_modules['bar'].runs)
+    finally:
+      common.config.WARM_TARGET_ENVIRONMENTS = saved_warm_environments
+      for env in target_env._warm_environments.values():
+        env.Discard()
+      target_env._warm_environments.clear()
+
   def testWsgiAppInPackageModule(self):
     self._env._TearDown()  # RunScript will set up the env
     self._tree.SetFile('foo/bar.py', _WSGI_MAIN)
@@ -634,6 +815,20 @@ _test_portal.module = sys.modules['%s']
     # check that sys.module has been restored
     self.assertEquals(sys.modules[module_key], original_module)
 
+  def testReboundModulesRestored(self):
+    info_module = sys.modules[target_info.__name__]
+    self._tree.SetFile('foo.py', """
+import sys
+sys.modules['%s'] = object()
+del sys.modules['tests.testpackage']
+""" % target_info.__name__)
+    import foo  # pylint: disable-msg=C6204, W0612
+    self.assertIsNot(info_module, sys.modules[target_info.__name__])
+    self._env._TearDown()
+    self.assertIs(info_module, sys.modules[target_info.__name__])
+    self.assertIs(testpackage, sys.modules['tests.testpackage'])
+    self._env._SetUp()
+
   def testRunScriptWithMainMethod(self):
     self._env._TearDown()  # RunScript will set up the env
     self._tree.SetFile('d/foo.py', """
@@ -756,6 +951,21 @@ logging.debug('running foo.py')
     self.assertEquals('abc', a_file.read())
     self.assertRaises(IOError, open, 'bar.txt')  # file doesn't exist
 
+  def testReadTargetFileLines(self):
+    self._tree.SetFile('foo.txt', 'a\nbc\nd')
+    a_file = open('foo.txt')
+    self.assertEquals('a\n', a_file.readline())
+    self.assertEquals(2, a_file.tell())
+    self.assertEquals(['bc\n', 'd'], list(a_file))
+    a_file.seek(0)
+    self.assertEquals('a\n', next(a_file))
+    self.assertEquals(['bc\n', 'd'], a_file.readlines())
+    self.assertFalse(a_file.closed)
+    with open('foo.txt') as a_file:
+      self.assertEquals('a\nbc\nd', a_file.read())
+    self.assertTrue(a_file.closed)
+    self.assertRaises(ValueError, a_file.read)
+
   def testOpenUniversalMode(self):
     self._tree.SetFile('foo.txt', 'a\nb\rc\r\nd')
     # no conversion in normal mode
@@ -1054,6 +1264,22 @@ handlers:
         'ProjectName',
         test_portal=_test_portal)
 
+  def testStaticFilesPatternsKeptApart(self):
+    config = yaml.load(r"""
+handlers:
+- url: /(.*)
+  static_files: docs/\1
+  upload: (?i)docs/(.*)\.TXT
+- url: /(.*)
+  static_files: images/\1
+  upload: images/(.*)\.jpg
+""")
+    env = target_env.TargetEnvironment(self._tree, config, 'ProjectName')
+    self.assertTrue(env._IsStaticFile('docs/readme.txt'))
+    self.assertTrue(env._IsStaticFile('images/pic.jpg'))
+    # the inline flag only applies to its own handler
+    self.assertFalse(env._IsStaticFile('IMAGES/pic.JPG'))
+
   def testOpenStaticFile(self):
     self._env._TearDown()  # RunScript will set up the env
     self._tree.SetFile('template.html', 'template text')
@@ -1099,6 +1325,66 @@ except IOError, e:
     self.assertEqual(no_ent_error_msg, handler.records[3].getMessage())
     self.assertEqual(no_ent_error_msg, handler.records[4].getMessage())
 
+  def testWalk(self):
+    self._tree.SetFile('foo.txt', 'abc')
+    self._tree.SetFile('d/bar.txt', 'def')
+    self._tree.SetFile('d/e/f/baz.txt', 'ghi')
+    self._tree.SetFile('d-x/qux.txt', 'jkl')
+    self.assertEquals([('/target', ['d', 'd-x'], ['foo.txt']),
+                       ('/target/d', ['e'], ['bar.txt']),
+                       ('/target/d/e', ['f'], []),
+                       ('/target/d/e/f', [], ['baz.txt']),
+                       ('/target/d-x', [], ['qux.txt'])],
+                      list(os.walk('/target')))
+    self.assertEquals([('d/e/f', [], ['baz.txt']),
+                       ('d/e', ['f'], []),
+                       ('d', ['e'], ['bar.txt'])],
+                      list(os.walk('d', topdown=False)))
+    # pruning
+    results = []
+    for dirpath, dirnames, unused_filenames in os.walk(''):
+      results.append(dirpath)
+      if 'd' in dirnames:
+        dirnames.remove('d')
+    self.assertEquals(['', 'd-x'], results)
+    # directories were remembered
+    self.assertEquals(1, self._env.path_info_misses)
+    self.assertTrue(os.path.isdir('d/e'))
+    self.assertEquals(1, self._env.path_info_misses)
+    # errors
+    errors = []
+    self.assertEquals([], list(os.walk('foo.txt', onerror=errors.append)))
+    self.assertEquals(1, len(errors))
+    self.assertEquals(errno.ENOENT, errors[0].errno)
+
+  def testExistsAndGetSize(self):
+    self._tree.SetFile('foo.txt', 'abc')
+    self.assertTrue(os.path.exists('foo.txt'))
+    self.assertTrue(os.path.lexists('/target/foo.txt'))
+    self.assertFalse(os.path.exists('bar.txt'))
+    self.assertEquals(3, os.path.getsize('foo.txt'))
+    self.assertEquals(os.stat('foo.txt'), os.lstat('foo.txt'))
+
+  def testPathInfoCached(self):
+    self._tree.SetFile('foo.txt', 'abc')
+    self.assertEquals(3, os.stat('foo.txt').st_size)
+    self.assertTrue(os.path.isfile('foo.txt'))
+    self.assertFalse(os.path.isdir('foo.txt'))
+    self.assertTrue(os.access('foo.txt', os.R_OK))
+    self.assertEquals((3, 1), (self._env.path_info_hits,
+                               self._env.path_info_misses))
+    # a change to the tree is seen
+    self._tree.SetFile('foo.txt', 'abcdef')
+    self.assertEquals(6, os.stat('foo.txt').st_size)
+    self.assertEquals((3, 2), (self._env.path_info_hits,
+                               self._env.path_info_misses))
+
+  def testRootOfEmptyTree(self):
+    self.assertTrue(os.path.isdir('/target'))
+    self.assertFalse(os.path.isfile('/target'))
+    self.assertTrue(os.access('/target', os.R_OK))
+    self.assertEquals([], list(os.walk('/target'))[0][2])
+
   def testStatOnFile(self):
     """Tests patched stat on a file in the target file system."""
     self._env._TearDown()  # RunScript will set up the env
@@ -1223,6 +1509,19 @@ except OSError, e:
     self.assertFalse(self._env._IsSkippedFile('pic.jpg'))
     self.assertFalse(self._env._IsSkippedFile('/target/pic.jpg'))
 
+  def testClassifyPath(self):
+    # see _TEST_CONFIG
+    self.assertEquals(target_env._PATH_STATIC,
+                      self._env._ClassifyPath('static/pic.jpg'))
+    self.assertEquals(target_env._PATH_SKIPPED,
+                      self._env._ClassifyPath('/target/folder/README.txt'))
+    self.assertEquals(target_env._PATH_OK, self._env._ClassifyPath('main.py'))
+    # results are remembered
+    self._env._skip_files_pattern = None
+    self.assertEquals(target_env._PATH_SKIPPED,
+                      self._env._ClassifyPath('/target/folder/README.txt'))
+    self.assertEquals(target_env._PATH_OK, self._env._ClassifyPath('README'))
+
   def testOpenSkippedFile(self):
     self._env._TearDown()  # RunScript will set up the env
     self._tree.SetFile('README.txt', 'readme')
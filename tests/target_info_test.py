@@ -524,5 +524,67 @@ class FindPageTest(unittest.TestCase):
                       target_info.FindPage, config, '/index.html')
 
 
+class AppConfigTest(unittest.TestCase):
+  """Tests for AppConfig."""
+
+  def testFindPage(self):
+    app_config = target_info.AppConfig(yaml.load(APP_YAML))
+    self.assertEquals(target_info.StaticPage('static/images/foo.png'),
+                      app_config.FindPage('/images/foo.png'))
+    self.assertEquals(target_info.StaticPage('static/images/bar.png'),
+                      app_config.FindPage('/images/bar.png'))
+    self.assertIsNone(app_config.FindPage('/foo.html'))
+
+  def testFirstMatchWins(self):
+    app_config = target_info.AppConfig(yaml.load(APP_YAML + r"""
+- url: /images/(.*\.py)
+  script: \1
+- url: /(.*\.py)
+  script: \1
+- url: /
+  static_dir: root
+- url: /.*
+  script: main.app
+"""))
+    # static_dir /images precedes the first script handler
+    self.assertEquals(target_info.StaticPage('static/images/foo.py'),
+                      app_config.FindPage('/images/foo.py'))
+    self.assertEquals(target_info.ScriptPage('foo.py'),
+                      app_config.FindPage('/foo.py'))
+    self.assertEquals(target_info.StaticPage('root/foo.html'),
+                      app_config.FindPage('/foo.html'))
+    self.assertEquals(target_info.StaticPage('root/images'),
+                      app_config.FindPage('/images'))
+
+  def testCachedPages(self):
+    app_config = target_info.AppConfig(yaml.load(APP_YAML))
+    page = app_config.FindPage('/images/foo.png')
+    self.assertIs(page, app_config.FindPage('/images/foo.png'))
+    for i in range(target_info._MAX_CACHED_PAGES):
+      app_config.FindPage('/images/{0}.png'.format(i))
+    self.assertIsNot(page, app_config.FindPage('/images/foo.png'))
+    self.assertEquals(page, app_config.FindPage('/images/foo.png'))
+
+  def testLiteralPrefix(self):
+    self.assertEquals('/images/', target_info._LiteralPrefix('/images/(.*)'))
+    self.assertEquals('/', target_info._LiteralPrefix(r'/(.*\.py)(\?.*)?'))
+    self.assertEquals('/fo', target_info._LiteralPrefix('/foo?'))
+    self.assertEquals('', target_info._LiteralPrefix('/foo|/bar'))
+    self.assertEquals('', target_info._LiteralPrefix('(?i)/foo'))
+
+  def testInvalidConfig(self):
+    config = yaml.load(APP_YAML + '\ninvalid_field: foo\n')
+    self.assertRaises(target_info.ValidationError, target_info.AppConfig,
+                      config)
+
+  def testInvalidUrl(self):
+    config = yaml.load(APP_YAML + """
+- url: /(foo
+  script: foo.app
+""")
+    self.assertRaises(target_info.ValidationError, target_info.AppConfig,
+                      config)
+
+
 if __name__ == '__main__':
   unittest.main()